@@ -1,21 +1,56 @@
+import math
+from collections import OrderedDict, deque
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from profiling import Profiler
+import rowboard
+import symmetry
+
+
+class BoardEncoder(nn.Module):
+    # Expands boards of log2 exponents into network input channels:
+    # 'raw' tile values (what the saved models were trained on), 'log2'
+    # exponents scaled to [0, 1], or one 'one_hot' plane per exponent.
+    def __init__(self, encoding='raw', num_exponents=16, size=4):
+        super(BoardEncoder, self).__init__()
+        if encoding not in ('raw', 'log2', 'one_hot'):
+            raise ValueError(f'unknown board encoding: {encoding}')
+        self.encoding = encoding
+        self.num_exponents = num_exponents
+        self.size = size
+        self.channels = num_exponents if encoding == 'one_hot' else 1
+
+    def forward(self, x):
+        x = x.view(-1, self.size, self.size)
+        if self.encoding == 'one_hot':
+            x = F.one_hot(x.long(), self.num_exponents)
+            return x.permute(0, 3, 1, 2).float().contiguous()
+        x = x.float()
+        if self.encoding == 'log2':
+            x = x / (self.num_exponents - 1)
+        else:
+            x = torch.exp2(x) * (x > 0)
+        return x.unsqueeze(1)
 
 
 class DQN(nn.Module):
-    def __init__(self):
+    def __init__(self, encoding='raw', size=4):
         super(DQN, self).__init__()
-        self.conv1 = nn.Conv2d(1, 32, kernel_size=3, stride=1, padding=1)
+        # The convolutions keep the board size, so only fc1 depends on it.
+        self.size = size
+        self.encoder = BoardEncoder(encoding, rowboard.num_exponents(size), size)
+        self.conv1 = nn.Conv2d(self.encoder.channels, 32,
+                               kernel_size=3, stride=1, padding=1)
         self.conv2 = nn.Conv2d(32, 64, kernel_size=3, stride=1, padding=1)
 
-        self.fc1 = nn.Linear(64*16, 512)
+        self.fc1 = nn.Linear(64*size*size, 512)
         self.fc2 = nn.Linear(512, 128)
         self.fc3 = nn.Linear(128, 4)
 
     def forward(self, x):
-        x = x.view(-1, 1, 4, 4) 
+        x = self.encoder(x)
         x = F.relu(self.conv1(x))
         x = F.relu(self.conv2(x))
 
@@ -31,80 +66,189 @@ class DQN(nn.Module):
 class SumTree:
     def __init__(self, capacity):
         self.capacity = capacity
-        self.tree = np.zeros(2*capacity - 1)
-        self.data = np.zeros(capacity, dtype=object)
-        self.pointer = 0
-
-    def add(self, priority, data):
-        idx = self.pointer + self.capacity - 1
-        self.data[self.pointer] = data
-        self.update(idx, priority)
-        self.pointer = (self.pointer + 1) % self.capacity
-
-    def update(self, idx, priority):
-        change = priority - self.tree[idx]
-        self.tree[idx] = priority
+        # Padding the leaves to a power of two keeps every leaf at the same
+        # depth, so a batch of lookups descends in lockstep.
+        self.depth = max(0, (capacity - 1).bit_length())
+        self.leaf_offset = (1 << self.depth) - 1
+        self.tree = np.zeros(2*self.leaf_offset + 1)
+
+    def update(self, idxs, priorities):
+        if np.ndim(idxs) == 0:
+            self._update_one(int(idxs), priorities)
+            return
+        idxs = np.atleast_1d(np.asarray(idxs, dtype=np.int64)) + self.leaf_offset
+        self.tree[idxs] = priorities
+        for _ in range(self.depth):
+            idxs = np.unique((idxs - 1) // 2)
+            self.tree[idxs] = self.tree[2*idxs + 1] + self.tree[2*idxs + 2]
+
+    def _update_one(self, idx, priority):
+        tree = self.tree
+        idx += self.leaf_offset
+        tree[idx] = priority
         while idx != 0:
             idx = (idx - 1) // 2
-            self.tree[idx] += change
-
-    def get(self, value):
-        idx = self._retrieve(0, value)
-        dataIdx = idx - self.capacity + 1
-        return (idx, self.tree[idx], self.data[dataIdx])
-
-    def _retrieve(self, idx, value):
-        left = 2 * idx + 1
-        right = left + 1
-        if left >= len(self.tree):
-            return idx
-        elif value <= self.tree[left]:
-            return self._retrieve(left, value)
-        else:
-            return self._retrieve(right, value - self.tree[left])
+            tree[idx] = tree[2*idx + 1] + tree[2*idx + 2]
+
+    def find(self, values):
+        values = np.array(values, dtype=np.float64)
+        idxs = np.zeros(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2*idxs + 1
+            left_sums = self.tree[left]
+            go_right = values > left_sums
+            values = np.where(go_right, values - left_sums, values)
+            idxs = np.where(go_right, left + 1, left)
+        return idxs - self.leaf_offset
+
+    def priorities(self, idxs):
+        return self.tree[np.asarray(idxs) + self.leaf_offset]
 
     def total(self):
         return self.tree[0]
 
 
+class ReplayMemory:
+    def __init__(self, capacity, state_shape=(4, 4), max_priority=1.):
+        self.capacity = capacity
+        self.tree = SumTree(capacity)
+        self.states = np.zeros((capacity, *state_shape), dtype=np.uint8)
+        self.actions = np.zeros(capacity, dtype=np.uint8)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros((capacity, *state_shape), dtype=np.uint8)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.pointer = 0
+        self.n_entries = 0
+        self.max_priority = max_priority
+        # Entries changed since they were last written to the checkpoint
+        # directory in self.checkpoint (see checkpoint.py).
+        self.dirty = np.zeros(capacity, dtype=bool)
+        self.checkpoint = None
+
+    def add(self, state, action, reward, next_state, done):
+        self.dirty[self.pointer] = True
+        self.states[self.pointer] = state
+        self.actions[self.pointer] = action
+        self.rewards[self.pointer] = reward
+        self.next_states[self.pointer] = next_state
+        self.dones[self.pointer] = done
+        self.tree.update(self.pointer, self.max_priority)
+        self.pointer = (self.pointer + 1) % self.capacity
+        self.n_entries = min(self.n_entries + 1, self.capacity)
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        idxs = (self.pointer + np.arange(len(actions))) % self.capacity
+        self.dirty[idxs] = True
+        self.states[idxs] = states
+        self.actions[idxs] = actions
+        self.rewards[idxs] = rewards
+        self.next_states[idxs] = next_states
+        self.dones[idxs] = dones
+        self.tree.update(idxs, np.full(len(idxs), self.max_priority))
+        self.pointer = (self.pointer + len(idxs)) % self.capacity
+        self.n_entries = min(self.n_entries + len(idxs), self.capacity)
+
+    def sample(self, batch_size):
+        # One uniform draw per equal-mass segment, as in stratified PER.
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) +
+                  np.random.uniform(size=batch_size)) * segment
+        # Rounding can push a draw past the last filled leaf.
+        idxs = np.minimum(self.tree.find(values), self.n_entries - 1)
+        return idxs, self.tree.priorities(idxs), (
+            self.states[idxs], self.actions[idxs], self.rewards[idxs],
+            self.next_states[idxs], self.dones[idxs])
+
+    def update_priorities(self, idxs, priorities):
+        self.dirty[idxs] = True
+        self.tree.update(idxs, priorities)
+        self.max_priority = max(self.max_priority, np.max(priorities))
+
+    def total(self):
+        return self.tree.total()
+
+    def __len__(self):
+        return self.n_entries
+
+
 class DDQNAgent:
-    def __init__(self, state_size, action_size):
+    def __init__(self, state_size, action_size, memory_capacity=6000, encoding='raw',
+                 augment=False, q_cache_size=0, gamma=0.9, epsilon=0.15, epsilon_min=0.001,
+                 epsilon_decay=0.999, alpha=0.6, beta=0.4, beta_increment=0.001,
+                 learning_rate=1e-4):
         self.state_size = state_size
         self.action_size = action_size
-        self.memory = SumTree(6000)
-        self.alpha = 0.6
-        self.beta = 0.4
-        self.beta_increment = 0.001
+        # state_size is the number of cells of a square board.
+        self.size = math.isqrt(state_size)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
         self.abs_error_upper = 1.
-        self.gamma = 0.9
-        self.epsilon = 0.15
-        self.epsilon_min = 0.001
-        self.epsilon_decay = 0.999
-        self.model = DQN()
-        self.target_model = DQN()
-        self.learning_rate = 1e-4
+        self.memory = ReplayMemory(
+            memory_capacity, (self.size, self.size), max_priority=self.abs_error_upper)
+        self.gamma = gamma
+        self.epsilon = epsilon
+        self.epsilon_min = epsilon_min
+        self.epsilon_decay = epsilon_decay
+        self.model = DQN(encoding, self.size)
+        self.target_model = DQN(encoding, self.size)
+        self.learning_rate = learning_rate
         self.optimizer = torch.optim.RMSprop(
             self.model.parameters(), lr=self.learning_rate)
         # self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=100, gamma=0.9)
-        self.criterion = nn.MSELoss()
-        self.losses = []
+        self.criterion = nn.MSELoss(reduction='none')
+        # Only recent losses are kept; the metrics log holds the history.
+        self.losses = deque(maxlen=1000)
+        self.profiler = Profiler()
+        # augment trains each sampled transition in all 8 board symmetries;
+        # q_cache_size > 0 caches single-board Q-values by canonical board.
+        self.augment = augment
+        self.q_cache_size = q_cache_size
+        self.q_cache = OrderedDict()
+        # An optimized forward pass from inference.py for agents that only
+        # play; it is a frozen copy, so training does not update it.
+        self.predictor = None
 
     def remember(self, state, action, reward, next_state, done):
-        transition = (state, action, reward, next_state, done)
-        max_priority = np.max(self.memory.tree[-self.memory.capacity:])
-        if max_priority == 0:
-            max_priority = self.abs_error_upper
-        self.memory.add(max_priority, transition)
+        self.memory.add(state, action, reward, next_state, done)
+
+    def predict(self, states):
+        self.profiler.count('inference')
+        if self.predictor is not None:
+            return self.predictor(states)
+        with torch.inference_mode():
+            return self.model(torch.as_tensor(states)).numpy()
+
+    def q_values(self, state):
+        if self.q_cache_size and np.ndim(state) == 2:
+            return self.cached_q_values(state)
+        return self.predict(state)
+
+    def cached_q_values(self, state):
+        key, k = symmetry.canonical(state)
+        q = self.q_cache.get(key)
+        if q is None:
+            q = self.predict(np.ascontiguousarray(symmetry.transform(state, k)))
+            self.q_cache[key] = q
+            if len(self.q_cache) > self.q_cache_size:
+                self.q_cache.popitem(last=False)
+        else:
+            self.profiler.count('q_cache_hits')
+            self.q_cache.move_to_end(key)
+        # Action a on this board is action ACTIONS[k][a] on the canonical one.
+        return q[:, symmetry.ACTIONS[k]]
 
-    def act(self, state, invalid_moves):
+    def act(self, state, invalid_moves, act_values=None):
         valid_actions = [action for action in [
             0, 1, 2, 3] if action not in invalid_moves]
 
         if np.random.rand() <= self.epsilon:
             return np.random.choice(valid_actions)
         else:
-            act_values = self.model(state)
-            action_values = act_values.detach().numpy()
+            # Callers that already evaluated the state can pass its Q-values.
+            if act_values is None:
+                act_values = self.q_values(state)
+            action_values = act_values.copy()
             action_values[0][invalid_moves] = -np.inf
 
             if np.random.rand() <= 0.000:
@@ -115,55 +259,63 @@ class DDQNAgent:
         self.target_model.load_state_dict(self.model.state_dict())
 
     def replay(self, batch_size):
-        this_loss = []
-        minibatch = []
-        idxs = []
-        segment = self.memory.total() / batch_size
-        priorities = []
-
         self.beta = np.min([1., self.beta + self.beta_increment])
 
-        for i in range(batch_size):
-            a = segment * i
-            b = segment * (i + 1)
-            value = np.random.uniform(a, b)
-            idx, priority, data = self.memory.get(value)
-            priorities.append(priority)
-            idxs.append(idx)
-            minibatch.append(data)
-
-        for i in range(batch_size):
-            state, action, reward, next_state, done = minibatch[i]
-            target = self.model(state)
-            target_new = target.clone()
-            if done:
-                target_new[0][action] = reward
-            else:
-                t = self.target_model(next_state.detach())
-                target_new[0][action] = reward + \
-                    self.gamma * torch.max(t).item()
-
-            self.optimizer.zero_grad()
-            loss = self.criterion(target, target_new)
-            loss.backward()
-
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1)
-
-            self.optimizer.step()
-
-            td_error = abs(
-                target_new[0][action].item() - target[0][action].item())
-            updated_priority = (td_error + 1e-5) ** self.alpha
-            self.memory.update(idxs[i], updated_priority)
-
-            this_loss.append(loss.item())
-        self.losses.append(np.mean(this_loss))
+        with self.profiler.phase('replay_sample'):
+            idxs, priorities, (states, actions, rewards, next_states, dones) = \
+                self.memory.sample(batch_size)
+
+        # Importance-sampling weights undo the bias of prioritized sampling.
+        probabilities = priorities / self.memory.total()
+        weights = (len(self.memory) * probabilities) ** -self.beta
+        weights = torch.from_numpy(weights / weights.max()).float()
+        if self.augment:
+            states, actions, rewards, next_states, dones = symmetry.augment(
+                states, actions, rewards, next_states, dones)
+            weights = weights.repeat(symmetry.NUM_SYMMETRIES)
+
+        with self.profiler.phase('replay_learn'):
+            loss, td_errors = self.learn(
+                torch.from_numpy(states),
+                torch.from_numpy(actions).long(),
+                torch.from_numpy(rewards),
+                torch.from_numpy(next_states),
+                torch.from_numpy(dones).float(),
+                weights)
+
+        if self.augment:
+            td_errors = td_errors.reshape(symmetry.NUM_SYMMETRIES, -1).mean(axis=0)
+        with self.profiler.phase('replay_priorities'):
+            self.memory.update_priorities(idxs, (td_errors + 1e-5) ** self.alpha)
+        self.profiler.count('replay_updates')
+        self.losses.append(loss)
 
         if self.epsilon > self.epsilon_min:
             self.epsilon *= self.epsilon_decay
 
+    def learn(self, states, actions, rewards, next_states, dones, weights):
+        batch = torch.arange(len(actions))
+        q_values = self.model(states)
+        with torch.no_grad():
+            next_q = self.target_model(next_states).max(dim=1)[0]
+            targets = q_values.detach().clone()
+            targets[batch, actions] = rewards + \
+                self.gamma * next_q * (1 - dones)
+
+        loss = (weights * self.criterion(q_values, targets).mean(dim=1)).mean()
+        self.optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1)
+        self.optimizer.step()
+        self.q_cache.clear()
+
+        td_errors = (targets[batch, actions] -
+                     q_values.detach()[batch, actions]).abs()
+        return loss.item(), td_errors.numpy()
+
     def load(self, name):
         self.model.load_state_dict(torch.load(name))
+        self.q_cache.clear()
 
     def save(self, name):
         torch.save(self.model.state_dict(), name)
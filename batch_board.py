@@ -0,0 +1,180 @@
+import numpy as np
+import bitboard
+
+# Numpy copies of the bitboard row tables, indexed by a row packed as four
+# 4-bit log2 nibbles (cell 0 in the lowest nibble).
+ROW_LEFT = np.array(bitboard.ROW_LEFT, dtype=np.uint16)
+ROW_RIGHT = np.array(bitboard.ROW_RIGHT, dtype=np.uint16)
+SCORE_LEFT = np.array(bitboard.SCORE_LEFT, dtype=np.int64)
+SCORE_RIGHT = np.array(bitboard.SCORE_RIGHT, dtype=np.int64)
+CAN_LEFT = ROW_LEFT != np.arange(65536)
+CAN_RIGHT = ROW_RIGHT != np.arange(65536)
+ROW_CELLS = ((np.arange(65536)[:, None] >> (4*np.arange(4))) & 0xF).astype(np.uint8)
+
+# Indexed like Board.all_moves: (transposed, row table, score table).
+MOVES = [
+    (False, ROW_LEFT, SCORE_LEFT),
+    (True, ROW_RIGHT, SCORE_RIGHT),
+    (False, ROW_RIGHT, SCORE_RIGHT),
+    (True, ROW_LEFT, SCORE_LEFT),
+]
+
+
+def pack_rows(grids):
+    grids = grids.astype(np.uint16)
+    return grids[..., 0] | grids[..., 1] << 4 | grids[..., 2] << 8 | grids[..., 3] << 12
+
+
+def compact_left(rows):
+    order = np.argsort(rows == 0, axis=1, kind='stable')
+    return np.take_along_axis(rows, order, axis=1)
+
+
+def slide_left(rows):
+    # Rows of any length as (M, n) exponents, merged with array operations
+    # one column pair at a time: for boards too wide for row tables.
+    rows = compact_left(rows)
+    scores = np.zeros(len(rows), dtype=np.int64)
+    for i in range(rows.shape[1] - 1):
+        merge = (rows[:, i] != 0) & (rows[:, i] == rows[:, i+1])
+        rows[merge, i] += 1
+        rows[merge, i+1] = 0
+        scores[merge] += np.left_shift(1, rows[merge, i].astype(np.int64))
+    return compact_left(rows), scores
+
+
+def can_slide(grids, right):
+    # Per board: does any row slide left (or right)?
+    a, b = grids[..., :-1], grids[..., 1:]
+    if right:
+        a, b = b, a
+    return (((a == 0) & (b != 0)) | ((a != 0) & (a == b))).any(axis=(-2, -1))
+
+
+def orient(grids, action, inverse=False):
+    # Turns the boards so that the action slides their rows left, or with
+    # inverse=True turns them back.
+    if inverse and action in (1, 2):
+        grids = grids[..., ::-1]
+    if action in (1, 3):
+        grids = grids.transpose(0, 2, 1)
+    if not inverse and action in (1, 2):
+        grids = grids[..., ::-1]
+    return grids
+
+
+class BatchBoard:
+    # 4x4 boards move through the bitboard row tables; other sizes use the
+    # vectorized slide_left.
+    def __init__(self, num_boards, size=4, random_seed=None):
+        self.num_boards = num_boards
+        self.size = size
+        self.all_moves = ['left', 'down', 'right', 'up']
+        self.rng = np.random.default_rng(random_seed)
+        self.grids = np.zeros((num_boards, size, size), dtype=np.uint8)
+        self.scores = np.zeros(num_boards, dtype=np.int64)
+        self.turns = np.zeros(num_boards, dtype=np.int64)
+        self.invalid_moves = np.zeros(num_boards, dtype=np.int64)
+        self.final_states = self.grids[:0].copy()
+        self.final_scores = self.scores[:0].copy()
+        self.final_turns = self.turns[:0].copy()
+        self.final_invalid_moves = self.invalid_moves[:0].copy()
+        self.reset()
+
+    def reset(self, idx=None):
+        if idx is None:
+            idx = np.arange(self.num_boards)
+        self.grids[idx] = 0
+        self.scores[idx] = 0
+        self.turns[idx] = 0
+        self.invalid_moves[idx] = 0
+        for _ in range(2):
+            self.add_random_tiles(idx)
+        return self.grids.copy()
+
+    def add_random_tiles(self, idx):
+        if len(idx) == 0:
+            return
+        flat = self.grids[idx].reshape(len(idx), -1)
+        # Uniform over the empty cells: occupied cells can never win the argmax.
+        keys = np.where(flat == 0, self.rng.random(flat.shape), -1.)
+        cells = keys.argmax(axis=1)
+        exponents = np.where(self.rng.random(len(idx)) < 0.9, 1, 2)
+        flat[np.arange(len(idx)), cells] = exponents
+        self.grids[idx] = flat.reshape(-1, self.size, self.size)
+
+    def slide(self, grids, actions):
+        if self.size != 4:
+            return self.slide_any_size(grids, actions)
+        new = grids.copy()
+        gained = np.zeros(len(grids), dtype=np.int64)
+        for action, (transposed, row_table, score_table) in enumerate(MOVES):
+            sel = np.flatnonzero(actions == action)
+            if len(sel) == 0:
+                continue
+            oriented = grids[sel]
+            if transposed:
+                oriented = oriented.transpose(0, 2, 1)
+            rows = pack_rows(oriented)
+            moved = ROW_CELLS[row_table[rows]]
+            if transposed:
+                moved = moved.transpose(0, 2, 1)
+            new[sel] = moved
+            gained[sel] = score_table[rows].sum(axis=1)
+        return new, gained
+
+    def slide_any_size(self, grids, actions):
+        new = grids.copy()
+        gained = np.zeros(len(grids), dtype=np.int64)
+        for action in range(4):
+            sel = np.flatnonzero(actions == action)
+            if len(sel) == 0:
+                continue
+            rows = orient(grids[sel], action).reshape(-1, self.size)
+            moved, scores = slide_left(rows)
+            new[sel] = orient(moved.reshape(-1, self.size, self.size), action, inverse=True)
+            gained[sel] = scores.reshape(len(sel), self.size).sum(axis=1)
+        return new, gained
+
+    def valid_action_masks(self, grids=None):
+        if grids is None:
+            grids = self.grids
+        if self.size != 4:
+            columns = grids.transpose(0, 2, 1)
+            return np.stack([can_slide(grids, False), can_slide(columns, True),
+                             can_slide(grids, True), can_slide(columns, False)], axis=1)
+        rows = pack_rows(grids)
+        cols = pack_rows(grids.transpose(0, 2, 1))
+        masks = np.empty((len(grids), 4), dtype=bool)
+        masks[:, 0] = CAN_LEFT[rows].any(axis=1)
+        masks[:, 1] = CAN_RIGHT[cols].any(axis=1)
+        masks[:, 2] = CAN_RIGHT[rows].any(axis=1)
+        masks[:, 3] = CAN_LEFT[cols].any(axis=1)
+        return masks
+
+    def step(self, actions):
+        actions = np.asarray(actions)
+        new, gained = self.slide(self.grids, actions)
+        moved = (new != self.grids).any(axis=(1, 2))
+        self.grids = new
+        self.turns += 1
+        self.invalid_moves += ~moved
+        self.scores += gained
+        rewards = np.where(moved, np.log2(1+gained)/16, -1.).astype(np.float32)
+
+        self.add_random_tiles(np.flatnonzero(moved))
+        masks = self.valid_action_masks()
+        dones = ~masks.any(axis=1)
+
+        # Finished games are restarted in place; their last board and stats
+        # stay available until the next step.
+        done_idx = np.flatnonzero(dones)
+        self.final_states = self.grids[done_idx]
+        self.final_scores = self.scores[done_idx]
+        self.final_turns = self.turns[done_idx]
+        self.final_invalid_moves = self.invalid_moves[done_idx]
+        if len(done_idx):
+            self.reset(done_idx)
+            masks[done_idx] = self.valid_action_masks(self.grids[done_idx])
+
+        return self.grids.copy(), rewards, dones, masks
@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+import torch
+from batch_board import BatchBoard
+from game_2048 import Board
+from RL import DQN, SumTree
+
+ENGINES = ['list', 'bitboard']
+# Board sizes other than 4x4, played by the list and rows engines.
+SIZES = [3, 6, 8]
+SUMTREE_CAPACITIES = [6000, 100000, 1000000, 10000000]
+DQN_BATCH_SIZES = [1, 4, 16, 64, 256, 1024]
+
+
+def measure(fn, repeat):
+    # Best of several runs: the least disturbed by the rest of the machine.
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(work, seconds, unit):
+    return {'value': work / seconds, 'unit': unit, 'seconds': seconds}
+
+
+def bench_board_move(engine, moves, repeat, size=4):
+    def run():
+        rng = random.Random(0)
+        env = Board(size, 0, engine=engine)
+        for _ in range(moves):
+            env.move(env.all_moves[rng.randrange(4)])
+            if env.done:
+                env.__init__(size, rng.randrange(1 << 30))
+    return result(moves, measure(run, repeat), 'moves/s')
+
+
+def bench_batch_board(size, boards, steps, repeat):
+    def run():
+        rng = np.random.default_rng(0)
+        batch = BatchBoard(boards, size, random_seed=0)
+        for _ in range(steps):
+            batch.step(rng.integers(4, size=boards))
+    return result(boards * steps, measure(run, repeat), 'steps/s')
+
+
+def bench_board_game_over(engine, boards, calls, repeat):
+    # Boards taken from the middle of seeded random games, so both early
+    # exits and full scans are exercised.
+    rng = random.Random(0)
+    envs = []
+    for seed in range(boards):
+        env = Board(4, seed, engine=engine)
+        for _ in range(rng.randrange(200)):
+            if env.done:
+                break
+            env.move(env.all_moves[rng.randrange(4)])
+        envs.append(env)
+
+    def run():
+        for i in range(calls):
+            envs[i % boards].game_over()
+    return result(calls, measure(run, repeat), 'calls/s')
+
+
+def bench_random_games(engine, games, repeat):
+    def run():
+        rng = random.Random(0)
+        for seed in range(games):
+            env = Board(4, seed, engine=engine)
+            valid_moves = env.valid_move_mask()
+            while not env.done:
+                actions = env.mask_to_invalid_moves(~valid_moves & 0xF)
+                _, _, _, valid_moves = env.move_with_mask(env.all_moves[rng.choice(actions)])
+    return result(games, measure(run, repeat), 'games/s')
+
+
+def bench_sumtree(capacity, operations, batch_size, repeat):
+    rng = np.random.default_rng(0)
+    tree = SumTree(capacity)
+    adds = rng.integers(capacity, size=operations)
+    priorities = rng.random(operations) + 1e-3
+
+    def add():
+        for idx, priority in zip(adds.tolist(), priorities.tolist()):
+            tree.update(idx, priority)
+    results = {'add': result(operations, measure(add, repeat), 'adds/s')}
+
+    batches = max(1, operations // batch_size)
+    values = rng.random((batches, batch_size)) * tree.total()
+    idxs = rng.integers(capacity, size=(batches, batch_size))
+    new_priorities = rng.random((batches, batch_size)) + 1e-3
+
+    def sample():
+        for batch in values:
+            tree.find(batch)
+
+    def update():
+        for batch_idxs, batch_priorities in zip(idxs, new_priorities):
+            tree.update(batch_idxs, batch_priorities)
+    results['sample'] = result(batches * batch_size, measure(sample, repeat), 'samples/s')
+    results['update'] = result(batches * batch_size, measure(update, repeat), 'updates/s')
+    return results
+
+
+def bench_dqn(batch_size, iterations, repeat, encoding='raw'):
+    torch.manual_seed(0)
+    model = DQN(encoding)
+    optimizer = torch.optim.RMSprop(model.parameters(), lr=1e-4)
+    states = torch.from_numpy(
+        np.random.default_rng(0).integers(0, 12, size=(batch_size, 4, 4), dtype=np.uint8))
+    targets = torch.rand(batch_size, 4)
+
+    def forward():
+        with torch.inference_mode():
+            for _ in range(iterations):
+                model(states)
+
+    def backward():
+        for _ in range(iterations):
+            loss = torch.nn.functional.mse_loss(model(states), targets)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    # The first passes pay for allocator and kernel warm-up.
+    forward()
+    backward()
+    return {
+        'forward': result(batch_size * iterations, measure(forward, repeat), 'samples/s'),
+        'backward': result(batch_size * iterations, measure(backward, repeat), 'samples/s'),
+    }
+
+
+def bench_train(episodes):
+    # train_DDQN writes under model/ and result/ relative to the working
+    # directory, so it runs in a scratch directory that is removed afterwards.
+    from main import train_DDQN
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix='bench_2048_')
+    try:
+        os.chdir(scratch)
+        os.makedirs('model')
+        os.makedirs('result')
+        start = time.perf_counter()
+        train_DDQN(episodes, 'benchmark', log_freq=episodes)
+        seconds = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {'value': episodes / seconds * 3600, 'unit': 'episodes/h', 'seconds': seconds}
+
+
+def run_benchmarks(quick=False, only=None, repeat=3):
+    scale = 10 if quick else 1
+    suite = {}
+    for engine in ENGINES:
+        # The list engine is slow enough that a tenth of the work is plenty.
+        work = 1 if engine == 'bitboard' else 10
+        suite[f'board.move.{engine}'] = lambda engine=engine, work=work: bench_board_move(
+            engine, 200000 // work // scale, repeat)
+        suite[f'board.game_over.{engine}'] = lambda engine=engine, work=work: bench_board_game_over(
+            engine, 256, 200000 // work // scale, repeat)
+        suite[f'random_games.{engine}'] = lambda engine=engine, work=work: bench_random_games(
+            engine, 200 // work // scale, repeat)
+    for size in SIZES:
+        for engine in ('list', 'rows'):
+            work = 1 if engine == 'rows' else 2
+            suite[f'board.move.{engine}.{size}'] = \
+                lambda engine=engine, size=size, work=work: bench_board_move(
+                    engine, 50000 // work // scale, repeat, size)
+    for size in (4, 8):
+        suite[f'batch_board.{size}'] = lambda size=size: bench_batch_board(
+            size, 1024, 200 // scale, repeat)
+    for capacity in SUMTREE_CAPACITIES:
+        suite[f'sumtree.{capacity}'] = lambda capacity=capacity: bench_sumtree(
+            capacity, 50000 // scale, 128, repeat)
+    for batch_size in DQN_BATCH_SIZES:
+        suite[f'dqn.{batch_size}'] = lambda batch_size=batch_size: bench_dqn(
+            batch_size, max(2, 4096 // batch_size // scale), repeat)
+    suite['train_DDQN'] = lambda: bench_train(300 if quick else 1000)
+
+    results = {}
+    for name, bench in suite.items():
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        outcome = bench()
+        # Benchmarks with several operations report each as name.operation.
+        if 'value' in outcome:
+            outcome = {name: outcome}
+        else:
+            outcome = {f'{name}.{operation}': value for operation, value in outcome.items()}
+        for key, value in outcome.items():
+            print(f"{key:32} {value['value']:14.1f} {value['unit']}")
+        results.update(outcome)
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    # Every benchmark is a throughput, so higher is better. Returns the names
+    # that got slower than the baseline by more than the threshold.
+    regressions = []
+    print(f"{'benchmark':32} {'baseline':>14} {'current':>14} {'change':>8}")
+    for name, current in results.items():
+        if name not in baseline:
+            print(f"{name:32} {'-':>14} {current['value']:14.1f} {'new':>8}")
+            continue
+        before = baseline[name]['value']
+        change = current['value'] / before - 1
+        flag = ''
+        if change < -threshold:
+            flag = '  slower'
+            regressions.append(name)
+        elif change > threshold:
+            flag = '  faster'
+        print(f"{name:32} {before:14.1f} {current['value']:14.1f} {change:+8.1%}{flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput of the game engines, the replay memory, '
+                    'the network and end-to-end training on the CPU.')
+    parser.add_argument('--output', default=None,
+                        help='JSON file for the results (default: result/benchmark_<time>.json)')
+    parser.add_argument('--compare', default=None, metavar='BASELINE',
+                        help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--only', nargs='*', default=None,
+                        help='run only benchmarks whose names start with these prefixes')
+    parser.add_argument('--quick', action='store_true', help='a tenth of the work per benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=1,
+                        help='torch intra-op threads; 1 keeps runs comparable across machines')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    results = run_benchmarks(args.quick, args.only, args.repeat)
+    output = args.output or f'result/benchmark_{time.strftime("%Y%m%d%H%M%S")}.json'
+    with open(output, 'w') as f:
+        json.dump({'environment': environment(), 'quick': args.quick,
+                   'results': results}, f, indent=2)
+    print(f'results written to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline['results'], args.threshold):
+            raise SystemExit(1)
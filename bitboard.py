@@ -0,0 +1,206 @@
+import math
+import random
+import numpy as np
+
+# A 4x4 board packed into a 64-bit integer: cell (r, c) holds the log2 of its
+# tile in the nibble at bit 4*(4*r + c), so row r is the 16-bit word at 16*r
+# and column c is its c-th nibble. Empty cells are 0.
+
+ROW_MASK = 0xFFFF
+MAX_EXPONENT = 15
+
+
+def _compact_left(cells):
+    # Stable sort on emptiness slides every tile of each row to the left.
+    order = np.argsort(cells == 0, axis=1, kind='stable')
+    return np.take_along_axis(cells, order, axis=1)
+
+
+def _pack(cells):
+    return (cells[:, 0] | cells[:, 1] << 4 | cells[:, 2] << 8 | cells[:, 3] << 12)
+
+
+def _build_tables():
+    # All 65536 rows at once, so importing this module stays cheap.
+    rows = np.arange(65536)
+    cells = _compact_left((rows[:, None] >> (4*np.arange(4))) & 0xF)
+    scores = np.zeros(65536, dtype=np.int64)
+    for i in range(3):
+        # 2**15 is the largest tile a nibble can hold, so it never merges.
+        merge = (cells[:, i] != 0) & (cells[:, i] == cells[:, i+1]) & \
+            (cells[:, i] < MAX_EXPONENT)
+        cells[merge, i] += 1
+        cells[merge, i+1] = 0
+        scores[merge] += 1 << cells[merge, i]
+    row_left = _pack(_compact_left(cells))
+
+    reverse = _pack((rows[:, None] >> (4*np.arange(3, -1, -1))) & 0xF)
+    row_right = reverse[row_left[reverse]]
+    score_right = scores[reverse]
+    # Bit 0: the row can slide left, bit 1: it can slide right.
+    can_move = (row_left != rows) | (row_right != rows) << 1
+    return (row_left.tolist(), row_right.tolist(), scores.tolist(),
+            score_right.tolist(), can_move.tolist(), reverse.tolist())
+
+
+ROW_LEFT, ROW_RIGHT, SCORE_LEFT, SCORE_RIGHT, ROW_CAN_MOVE, ROW_REVERSE = _build_tables()
+
+# The four exponents of every row as bytes, for building states without a
+# NumPy gather.
+_ROW_BYTES = ((np.arange(65536)[:, None] >> (4*np.arange(4))) & 0xF).astype(np.uint8).tobytes()
+ROW_EXPONENTS = [_ROW_BYTES[4*row:4*row + 4] for row in range(65536)]
+NIBBLE_LOW_BITS = 0x1111111111111111
+
+
+def transpose(board):
+    a1 = board & 0xF0F00F0FF0F00F0F
+    a2 = board & 0x0000F0F00000F0F0
+    a3 = board & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+
+def mirror(board):
+    # Reverses every row: column c goes to column 3 - c.
+    result = 0
+    for shift in (0, 16, 32, 48):
+        result |= ROW_REVERSE[(board >> shift) & ROW_MASK] << shift
+    return result
+
+
+def flip(board):
+    # Reverses the order of the rows: row r goes to row 3 - r.
+    return ((board & ROW_MASK) << 48 | (board >> 16 & ROW_MASK) << 32 |
+            (board >> 32 & ROW_MASK) << 16 | board >> 48)
+
+
+def symmetries(board):
+    # The 8 dihedral images of the board. Image k is transposed if k & 4,
+    # then mirrored if k & 1, then flipped if k & 2, matching symmetry.py.
+    images = []
+    for base in (board, transpose(board)):
+        mirrored = mirror(base)
+        images += [base, mirrored, flip(base), flip(mirrored)]
+    return images
+
+
+def _apply_rows(board, row_table, score_table):
+    result = 0
+    score = 0
+    for shift in (0, 16, 32, 48):
+        row = (board >> shift) & ROW_MASK
+        result |= row_table[row] << shift
+        score += score_table[row]
+    return result, score
+
+
+def move_left(board):
+    return _apply_rows(board, ROW_LEFT, SCORE_LEFT)
+
+
+def move_right(board):
+    return _apply_rows(board, ROW_RIGHT, SCORE_RIGHT)
+
+
+def move_up(board):
+    result, score = _apply_rows(transpose(board), ROW_LEFT, SCORE_LEFT)
+    return transpose(result), score
+
+
+def move_down(board):
+    result, score = _apply_rows(transpose(board), ROW_RIGHT, SCORE_RIGHT)
+    return transpose(result), score
+
+
+# Indexed like Board.all_moves: ['left', 'down', 'right', 'up'].
+MOVES = [move_left, move_down, move_right, move_up]
+
+
+def move(board, action):
+    return MOVES[action](board)
+
+
+def valid_move_mask(board):
+    # Bit i is set when MOVES[i] changes the board.
+    horizontal = 0
+    vertical = 0
+    transposed = transpose(board)
+    for shift in (0, 16, 32, 48):
+        horizontal |= ROW_CAN_MOVE[(board >> shift) & ROW_MASK]
+        vertical |= ROW_CAN_MOVE[(transposed >> shift) & ROW_MASK]
+    return (horizontal & 1) | (vertical >> 1) << 1 | \
+        (horizontal >> 1) << 2 | (vertical & 1) << 3
+
+
+def empty_positions(board):
+    return [(i // 4, i % 4) for i in range(16) if not (board >> (4*i)) & 0xF]
+
+
+def empty_bits(board):
+    # The lowest bit of every empty nibble: a nibble is empty when none of
+    # its four bits is set.
+    return ~(board | board >> 1 | board >> 2 | board >> 3) & NIBBLE_LOW_BITS
+
+
+def count_empty(board):
+    return empty_bits(board).bit_count()
+
+
+def game_over(board):
+    if count_empty(board):
+        return False
+    # On a full board a row can slide left exactly when it can slide right,
+    # so checking one direction per axis is enough.
+    return move_left(board)[0] == board and move_up(board)[0] == board
+
+
+def add_random_tile(board):
+    # randrange(n) is the draw random.choice makes on a list of n empty
+    # cells, so seeded games match the list engine. The k-th empty cell is
+    # found by clearing the k lowest empty bits.
+    empty = empty_bits(board)
+    for _ in range(random.randrange(empty.bit_count())):
+        empty &= empty - 1
+    shift = (empty & -empty).bit_length() - 1
+    # Same draw as random.choices([2, 4], weights=(90, 10)), without its overhead.
+    value = 2 if random.random() * 100 < 90 else 4
+    board |= (value.bit_length() - 1) << shift
+    return board, divmod(shift >> 2, 4), value
+
+
+def to_exponents(board):
+    rows = (ROW_EXPONENTS[board & ROW_MASK] + ROW_EXPONENTS[board >> 16 & ROW_MASK] +
+            ROW_EXPONENTS[board >> 32 & ROW_MASK] + ROW_EXPONENTS[board >> 48])
+    return np.frombuffer(bytearray(rows), dtype=np.uint8).reshape(4, 4)
+
+
+def reward(score):
+    return math.log2(1+score)/16
+
+
+def from_exponents(exponents):
+    nibbles = np.asarray(exponents, dtype=np.uint8).reshape(8, 2)
+    return int.from_bytes((nibbles[:, 0] | nibbles[:, 1] << 4).tobytes(), 'little')
+
+
+def to_grid(board):
+    grid = []
+    for x in range(4):
+        row = []
+        for y in range(4):
+            exponent = (board >> (4*(4*x + y))) & 0xF
+            row.append(1 << exponent if exponent else 0)
+        grid.append(row)
+    return grid
+
+
+def from_grid(grid):
+    board = 0
+    for x in range(4):
+        for y in range(4):
+            if grid[x][y]:
+                board |= (grid[x][y].bit_length() - 1) << (4*(4*x + y))
+    return board
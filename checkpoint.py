@@ -0,0 +1,219 @@
+import copy
+import os
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+AGENT_ATTRIBUTES = ['alpha', 'beta', 'beta_increment', 'abs_error_upper', 'gamma',
+                    'epsilon', 'epsilon_min', 'epsilon_decay', 'learning_rate', 'losses']
+MEMORY_ARRAYS = ['states', 'actions', 'rewards', 'next_states', 'dones']
+
+
+def tree_nodes(tree, leaves):
+    # The leaves and every node above them, the part of a SumTree that
+    # changes when the leaves do.
+    # leaves is sorted and so is every level above, so duplicates are
+    # neighbours.
+    idxs = leaves + tree.leaf_offset
+    if not len(idxs):
+        return idxs
+    nodes = [idxs]
+    for _ in range(tree.depth):
+        idxs = (idxs - 1) // 2
+        idxs = idxs[np.concatenate(([True], idxs[1:] != idxs[:-1]))]
+        nodes.append(idxs)
+    return np.concatenate(nodes)
+
+
+def snapshot(agent, training_state, path):
+    # Runs in the caller's thread, so training can keep mutating the agent
+    # while the snapshot is written out. Only replay entries changed since
+    # the last save to path are copied; a first save copies the filled part
+    # of the memory once.
+    memory = agent.memory
+    state = {
+        'agent': {
+            'model': copy.deepcopy(agent.model.state_dict()),
+            'target_model': copy.deepcopy(agent.target_model.state_dict()),
+            'optimizer': copy.deepcopy(agent.optimizer.state_dict()),
+            'attributes': copy.deepcopy({name: getattr(agent, name)
+                                         for name in AGENT_ATTRIBUTES}),
+            'memory': {
+                'pointer': memory.pointer,
+                'n_entries': memory.n_entries,
+                'max_priority': memory.max_priority,
+            },
+        },
+        'rng': {
+            'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+        },
+        'training': copy.deepcopy(training_state),
+        'capacity': memory.capacity,
+        'delta': memory.checkpoint == path and os.path.exists(path),
+    }
+    if state['delta']:
+        idxs = np.flatnonzero(memory.dirty)
+        nodes = tree_nodes(memory.tree, idxs)
+        state['arrays'] = {
+            **{name: getattr(memory, name)[idxs] for name in MEMORY_ARRAYS},
+            'tree': memory.tree.tree[nodes],
+            'index': idxs,
+            'nodes': nodes,
+        }
+    else:
+        # The ring buffer fills from 0, so entries past n_entries are zero.
+        state['arrays'] = {
+            **{name: getattr(memory, name)[:memory.n_entries].copy() for name in MEMORY_ARRAYS},
+            'tree': memory.tree.tree.copy(),
+        }
+    memory.dirty[:] = False
+    memory.checkpoint = path
+    return state
+
+
+def write_full(state, path):
+    # Write into a scratch directory and swap it in with renames, so a crash
+    # leaves either the previous checkpoint or the new one, never a mix.
+    tmp_path = f'{path}.tmp'
+    old_path = f'{path}.old'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in state['arrays'].items():
+        file_path = os.path.join(tmp_path, f'{name}.npy')
+        if name == 'tree':
+            np.save(file_path, array)
+            continue
+        out = np.lib.format.open_memmap(file_path, mode='w+', dtype=array.dtype,
+                                        shape=(state['capacity'], *array.shape[1:]))
+        out[:len(array)] = array
+        out.flush()
+        del out
+    torch.save({key: value for key, value in state.items() if key != 'arrays'},
+               os.path.join(tmp_path, 'state.pt'))
+
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def write_delta(state, path):
+    # The changed entries and the new state.pt go to a journal first; its
+    # rename is the commit point. A crash before it leaves the previous
+    # checkpoint, a crash after it is finished by apply_journal on load.
+    tmp_path = os.path.join(path, 'journal.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in state['arrays'].items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+    torch.save({key: value for key, value in state.items() if key != 'arrays'},
+               os.path.join(tmp_path, 'state.pt'))
+    os.rename(tmp_path, os.path.join(path, 'journal'))
+    apply_journal(path)
+
+
+def apply_journal(path):
+    # Writes a committed journal into the checkpoint's arrays in place.
+    # Applying it twice writes the same values, so an interrupted apply is
+    # simply repeated.
+    shutil.rmtree(os.path.join(path, 'journal.tmp'), ignore_errors=True)
+    journal = os.path.join(path, 'journal')
+    if not os.path.exists(journal):
+        return
+    index = np.load(os.path.join(journal, 'index.npy'))
+    for name in MEMORY_ARRAYS:
+        array = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r+')
+        array[index] = np.load(os.path.join(journal, f'{name}.npy'))
+        array.flush()
+        del array
+    tree = np.load(os.path.join(path, 'tree.npy'), mmap_mode='r+')
+    tree[np.load(os.path.join(journal, 'nodes.npy'))] = np.load(os.path.join(journal, 'tree.npy'))
+    tree.flush()
+    del tree
+    shutil.copyfile(os.path.join(journal, 'state.pt'), os.path.join(path, 'state.pt.tmp'))
+    os.replace(os.path.join(path, 'state.pt.tmp'), os.path.join(path, 'state.pt'))
+    shutil.rmtree(journal)
+
+
+def write(state, path):
+    if state['delta']:
+        write_delta(state, path)
+    else:
+        write_full(state, path)
+
+
+def save_checkpoint(agent, path, training_state):
+    write(snapshot(agent, training_state, path), path)
+
+
+class CheckpointWriter:
+    # Writes checkpoints on a background thread; at most one write is in
+    # flight, a new save first waits for the previous one to finish.
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, agent, path, training_state):
+        self.wait()
+        state = snapshot(agent, training_state, path)
+        self.thread = threading.Thread(target=self.run, args=(state, path), daemon=True)
+        self.thread.start()
+
+    def run(self, state, path):
+        try:
+            write(state, path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def checkpoint_exists(path):
+    return os.path.exists(path) or os.path.exists(f'{path}.old')
+
+
+def load_checkpoint(agent, path):
+    if not os.path.exists(path):
+        # Interrupted between the two renames in write().
+        path = f'{path}.old'
+    apply_journal(path)
+    state = torch.load(os.path.join(path, 'state.pt'), weights_only=False)
+
+    agent.model.load_state_dict(state['agent']['model'])
+    agent.target_model.load_state_dict(state['agent']['target_model'])
+    agent.optimizer.load_state_dict(state['agent']['optimizer'])
+    for name, value in state['agent']['attributes'].items():
+        setattr(agent, name, value)
+
+    # Copy-on-write memory maps: nothing is read until a page is touched,
+    # and writes made by training never reach the checkpoint files.
+    memory = agent.memory
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='c')
+              for name in MEMORY_ARRAYS}
+    if len(arrays['actions']) != memory.capacity:
+        raise ValueError(f'checkpoint holds a replay memory of {len(arrays["actions"])} '
+                         f'transitions, the agent has room for {memory.capacity}')
+    for name, array in arrays.items():
+        setattr(memory, name, array)
+    memory.tree.tree = np.load(os.path.join(path, 'tree.npy'), mmap_mode='c')
+    for name, value in state['agent']['memory'].items():
+        setattr(memory, name, value)
+    # Later saves to this directory only write what changes from here.
+    memory.dirty[:] = False
+    memory.checkpoint = path
+
+    random.setstate(state['rng']['python'])
+    np.random.set_state(state['rng']['numpy'])
+    torch.set_rng_state(state['rng']['torch'])
+    return state['training']
@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+from multiprocessing import Pool
+import numpy as np
+import torch
+import game_log
+import symmetry
+from game_2048 import Board
+from RL import DDQNAgent
+from expectimax import ExpectimaxAgent
+
+# A dataset is a directory of chunks, each a directory holding one .npy file
+# per array, laid out like the replay memory of DDQNAgent.
+ARRAYS = ['states', 'actions', 'rewards', 'next_states', 'dones']
+PLAYERS = ['random', 'heuristic', 'expectimax']
+
+_player = None
+
+
+def init_worker(player, time_budget):
+    global _player
+    if player == 'expectimax':
+        _player = ExpectimaxAgent(time_budget=time_budget)
+    elif player == 'heuristic':
+        # One ply of search on the expectimax heuristics: a fast greedy player.
+        _player = ExpectimaxAgent(time_budget=float('inf'), max_depth=1)
+    else:
+        _player = None
+
+
+def play_game(seed):
+    rng = random.Random(seed)
+    env = Board(4, seed, engine='bitboard', record=True)
+    valid_moves = env.valid_move_mask()
+    while not env.done:
+        invalid_moves = env.mask_to_invalid_moves(valid_moves)
+        if _player is None:
+            action = rng.choice([a for a in range(4) if a not in invalid_moves])
+        else:
+            action = _player.act(env.state, invalid_moves)
+        _, _, _, valid_moves = env.move_with_mask(env.all_moves[action])
+    return env
+
+
+def generate_chunk(task):
+    directory, chunk, seeds = task
+    path = os.path.join(directory, f'chunk_{chunk:06d}')
+    if os.path.exists(path):
+        return path, None
+    games = [play_game(seed) for seed in seeds]
+    arrays = [np.concatenate(parts) for parts in
+              zip(*(game_log.transitions(env.history) for env in games))]
+
+    # Written aside and renamed, so an interrupted run never leaves a
+    # partial chunk behind and can simply be started again.
+    tmp_path = f'{path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in zip(ARRAYS, arrays):
+        np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+    os.rename(tmp_path, path)
+    return path, [env.score_v2 for env in games]
+
+
+def generate(name, games=1000, player='random', workers=None, games_per_chunk=100,
+             first_seed=0, time_budget=0.01):
+    directory = f'data/{name}'
+    meta = {'player': player, 'games': games, 'first_seed': first_seed,
+            'games_per_chunk': games_per_chunk, 'time_budget': time_budget}
+    meta_path = os.path.join(directory, 'meta.json')
+    # Existing chunks are kept, so a rerun only resumes a dataset made with
+    # the same settings; anything else would mix two datasets under one meta.
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            existing = json.load(f)
+        if existing != meta:
+            changed = ', '.join(f'{key} {existing.get(key)} -> {value}'
+                                for key, value in meta.items() if existing.get(key) != value)
+            raise FileExistsError(f'dataset {name} was generated with other settings '
+                                  f'({changed}); give it another name')
+    else:
+        os.makedirs(directory, exist_ok=True)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    tasks = [(directory, chunk, range(seed, min(seed + games_per_chunk, first_seed + games)))
+             for chunk, seed in enumerate(range(first_seed, first_seed + games, games_per_chunk))]
+    start = time.perf_counter()
+    scores = []
+    with Pool(workers or os.cpu_count(), initializer=init_worker,
+              initargs=(player, time_budget)) as pool:
+        for i, (_, chunk_scores) in enumerate(pool.imap_unordered(generate_chunk, tasks)):
+            scores += chunk_scores or []
+            print(f'chunk {i+1}/{len(tasks)}, {time.perf_counter() - start:.1f}s')
+    if scores:
+        print(f'{len(scores)} games, mean score {np.mean(scores):.1f}')
+    return directory
+
+
+class TransitionDataset:
+    # All chunks of a dataset, memory-mapped: opening it reads nothing.
+    def __init__(self, directory):
+        self.directory = directory
+        names = sorted(name for name in os.listdir(directory)
+                       if name.startswith('chunk_') and not name.endswith('.tmp'))
+        self.chunks = [{array: np.load(os.path.join(directory, name, f'{array}.npy'),
+                                       mmap_mode='r') for array in ARRAYS}
+                       for name in names]
+
+    def __len__(self):
+        return sum(len(chunk['actions']) for chunk in self.chunks)
+
+
+class PrefetchLoader:
+    # Minibatches are assembled on a background thread and queued, so the
+    # learner never waits on disk. Chunks are read whole and in sequence
+    # (shuffled chunk order, shuffled within the chunk), which keeps reads
+    # at disk speed while still mixing games from different chunks.
+    def __init__(self, dataset, batch_size=128, shuffle=True, seed=0, prefetch=16):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.prefetch = prefetch
+
+    def batches(self):
+        order = np.arange(len(self.dataset.chunks))
+        if self.shuffle:
+            self.rng.shuffle(order)
+        leftover = None
+        for i in order:
+            arrays = [np.asarray(self.dataset.chunks[i][name]) for name in ARRAYS]
+            if leftover is not None:
+                arrays = [np.concatenate(pair) for pair in zip(leftover, arrays)]
+            if self.shuffle:
+                permutation = self.rng.permutation(len(arrays[1]))
+                arrays = [array[permutation] for array in arrays]
+            end = len(arrays[1]) - len(arrays[1]) % self.batch_size
+            for start in range(0, end, self.batch_size):
+                yield [array[start:start + self.batch_size] for array in arrays]
+            leftover = [array[end:] for array in arrays]
+
+    @staticmethod
+    def put(batches, stop, item):
+        # Gives up once the consumer has stopped, so a full queue never
+        # blocks the thread it is joined from. Returns False then.
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self, batches, stop):
+        try:
+            for batch in self.batches():
+                if not self.put(batches, stop, batch):
+                    return
+            self.put(batches, stop, None)
+        except Exception as e:
+            self.put(batches, stop, e)
+
+    def __iter__(self):
+        batches = queue.Queue(self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.run, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def train_offline(data_name, model_name, epochs=1, batch_size=128, target_update_freq=1000,
+                  log_freq=1000, encoding='raw', augment=False, random_seed=0):
+    # Offline DDQN on a generated dataset, through the same learning step as
+    # train_DDQN. Transitions are weighted uniformly.
+    np.random.seed(random_seed)
+    torch.manual_seed(random_seed)
+    agent = DDQNAgent(16, 4, memory_capacity=1, encoding=encoding, augment=augment)
+    model_path = f'model/{model_name}'
+    if os.path.exists(model_path):
+        print('exist')
+        agent.load(model_path)
+    agent.update_target_model()
+    dataset = TransitionDataset(f'data/{data_name}')
+    loader = PrefetchLoader(dataset, batch_size, seed=random_seed)
+    print(f'{len(dataset)} transitions in {len(dataset.chunks)} chunks')
+
+    updates = 0
+    losses = []
+    start = time.perf_counter()
+    for epoch in range(epochs):
+        for states, actions, rewards, next_states, dones in loader:
+            if augment:
+                states, actions, rewards, next_states, dones = symmetry.augment(
+                    states, actions, rewards, next_states, dones)
+            loss, _ = agent.learn(
+                torch.from_numpy(states),
+                torch.from_numpy(actions).long(),
+                torch.from_numpy(rewards),
+                torch.from_numpy(next_states),
+                torch.from_numpy(dones).float(),
+                torch.ones(len(actions)))
+            losses.append(loss)
+            updates += 1
+            if updates % target_update_freq == 0:
+                agent.update_target_model()
+            if updates % log_freq == 0:
+                elapsed = time.perf_counter() - start
+                print("epoch: {}, updates: {:9}, loss: {:.5f}, {:.1f} updates/s".format(
+                    epoch, updates, np.mean(losses[-log_freq:]), updates / elapsed))
+        agent.save(model_path)
+    return agent
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate transition datasets in bulk and train on them offline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='play games and store their transitions')
+    gen.add_argument('name', help='dataset directory under data/')
+    gen.add_argument('--games', type=int, default=1000)
+    gen.add_argument('--player', choices=PLAYERS, default='random')
+    gen.add_argument('--workers', type=int, default=None)
+    gen.add_argument('--games-per-chunk', type=int, default=100)
+    gen.add_argument('--seed', type=int, default=0, help='seed of the first game')
+    gen.add_argument('--time-budget', type=float, default=0.01,
+                     help='seconds per move for the expectimax player')
+
+    train = commands.add_parser('train', help='train a model on a stored dataset')
+    train.add_argument('name', help='dataset directory under data/')
+    train.add_argument('model_name', help='file name under model/, continued if it exists')
+    train.add_argument('--epochs', type=int, default=1)
+    train.add_argument('--batch-size', type=int, default=128)
+    train.add_argument('--target-update-freq', type=int, default=1000)
+    train.add_argument('--log-freq', type=int, default=1000)
+    train.add_argument('--encoding', default='raw')
+    train.add_argument('--augment', action='store_true',
+                       help='train every transition in all 8 board symmetries')
+    train.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        try:
+            generate(args.name, args.games, args.player, args.workers, args.games_per_chunk,
+                     args.seed, args.time_budget)
+        except FileExistsError as e:
+            parser.error(str(e))
+    else:
+        train_offline(args.name, args.model_name, args.epochs, args.batch_size,
+                      args.target_update_freq, args.log_freq, args.encoding, args.augment,
+                      args.seed)
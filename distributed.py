@@ -0,0 +1,177 @@
+import argparse
+import os
+import queue
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from game_2048 import Board
+from RL import DDQNAgent, DQN
+
+
+def actor_epsilon(actor_id, num_actors, base=0.4, spread=7):
+    # Ape-X style: every actor explores at a different fixed rate.
+    if num_actors == 1:
+        return base
+    return base ** (1 + spread * actor_id / (num_actors - 1))
+
+
+def run_actor(actor_id, num_actors, shared_model, weights_version, weights_lock,
+              transitions, stop, chunk_size, random_seed, encoding):
+    torch.set_num_threads(1)
+    np.random.seed(random_seed + actor_id)
+    agent = DDQNAgent(16, 4, memory_capacity=1, encoding=encoding)
+    agent.epsilon = actor_epsilon(actor_id, num_actors)
+    version = -1
+
+    states = np.zeros((chunk_size, 4, 4), dtype=np.uint8)
+    actions = np.zeros(chunk_size, dtype=np.uint8)
+    rewards = np.zeros(chunk_size, dtype=np.float32)
+    next_states = np.zeros((chunk_size, 4, 4), dtype=np.uint8)
+    dones = np.zeros(chunk_size, dtype=bool)
+    episodes = []
+    count = 0
+
+    env = Board(4, random_seed + actor_id, engine='bitboard')
+    while not stop.is_set():
+        if weights_version.value != version:
+            with weights_lock:
+                agent.model.load_state_dict(shared_model.state_dict())
+                version = weights_version.value
+
+        state = env.state
+        valid_moves = env.valid_move_mask()
+        while True:
+            with torch.no_grad():
+                action = agent.act(state, env.mask_to_invalid_moves(valid_moves))
+            next_state, reward, done, valid_moves = env.move_with_mask(
+                env.all_moves[action])
+            states[count] = state
+            actions[count] = action
+            rewards[count] = reward
+            next_states[count] = next_state
+            dones[count] = done
+            count += 1
+            state = next_state
+
+            if done:
+                episodes.append((env.score_v2, env.turns - env.invalid_move))
+            if count == chunk_size:
+                chunk = (states.copy(), actions.copy(), rewards.copy(),
+                         next_states.copy(), dones.copy(), episodes)
+                while not stop.is_set():
+                    try:
+                        transitions.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                episodes = []
+                count = 0
+            if done or stop.is_set():
+                break
+        env.__init__(4)
+
+
+def train_distributed(model_name, updates, num_actors=4, sync_interval=50,
+                      queue_size=64, chunk_size=256, batch_size=128,
+                      memory_capacity=1000000, target_update_freq=500,
+                      save_freq=5000, log_freq=500, random_seed=0,
+                      encoding='raw'):
+    ctx = mp.get_context('spawn')
+    agent = DDQNAgent(16, 4, memory_capacity=memory_capacity, encoding=encoding)
+    if os.path.exists(f'model/{model_name}'):
+        print('exist')
+        agent.load(f'model/{model_name}')
+    agent.update_target_model()
+
+    shared_model = DQN(encoding)
+    shared_model.load_state_dict(agent.model.state_dict())
+    shared_model.share_memory()
+    weights_version = ctx.Value('i', 0)
+    weights_lock = ctx.Lock()
+    transitions = ctx.Queue(maxsize=queue_size)
+    stop = ctx.Event()
+
+    actors = [ctx.Process(target=run_actor, daemon=True, args=(
+        actor_id, num_actors, shared_model, weights_version, weights_lock,
+        transitions, stop, chunk_size, random_seed, encoding))
+        for actor_id in range(num_actors)]
+    for process in actors:
+        process.start()
+
+    scores = []
+    received = 0
+    update = 0
+    start = time.time()
+    try:
+        while update < updates:
+            # Block only while the replay memory is too small to learn from.
+            block = len(agent.memory) < batch_size
+            while True:
+                try:
+                    chunk = transitions.get(block=block, timeout=1 if block else None)
+                except queue.Empty:
+                    break
+                agent.memory.add_batch(*chunk[:5])
+                scores.extend(score for score, _ in chunk[5])
+                received += len(chunk[1])
+                block = False
+            # Actors only return once stop is set, so any exit code here
+            # means one crashed and the memory would go stale.
+            for actor_id, process in enumerate(actors):
+                if process.exitcode is not None:
+                    raise RuntimeError(f'actor {actor_id} died with exit code {process.exitcode}')
+
+            if len(agent.memory) < batch_size:
+                continue
+            agent.replay(batch_size)
+            update += 1
+
+            if update % sync_interval == 0:
+                with weights_lock:
+                    shared_model.load_state_dict(agent.model.state_dict())
+                    weights_version.value += 1
+            if update % target_update_freq == 0:
+                agent.update_target_model()
+            if update % save_freq == 0:
+                agent.save(f'model/{model_name}')
+            if update % log_freq == 0:
+                elapsed = time.time() - start
+                print("update: {:9}/{}, episodes: {:8}, score(v2): {:9.1f}, transitions/s: {:9.0f}, updates/s: {:6.1f}"
+                      .format(update, updates, len(scores), np.mean(scores[-100:]) if scores else 0,
+                              received / elapsed, update / elapsed))
+    finally:
+        stop.set()
+        # Drain the queue so actors blocked in put() can exit.
+        while any(process.is_alive() for process in actors):
+            try:
+                transitions.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in actors:
+            process.join()
+    agent.save(f'model/{model_name}')
+    return agent
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Train the DDQN agent with parallel self-play actors.')
+    parser.add_argument('model_name')
+    parser.add_argument('--updates', type=int, default=1000000)
+    parser.add_argument('--actors', type=int, default=os.cpu_count() - 1 or 1)
+    parser.add_argument('--sync-interval', type=int, default=50,
+                        help='learner updates between weight syncs to actors')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='transition chunks buffered between actors and learner')
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help='transitions per chunk sent by an actor')
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--memory-capacity', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    train_distributed(args.model_name, args.updates, num_actors=args.actors,
+                      sync_interval=args.sync_interval, queue_size=args.queue_size,
+                      chunk_size=args.chunk_size, batch_size=args.batch_size,
+                      memory_capacity=args.memory_capacity, random_seed=args.seed)
@@ -0,0 +1,136 @@
+import argparse
+import csv
+import json
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+import torch
+from game_2048 import Board, default_engine
+from RL import DDQNAgent
+from expectimax import ExpectimaxAgent
+from inference import BACKENDS, load_model
+
+_agent = None
+_size = 4
+
+
+def init_worker(agent_type, model_path, encoding, time_budget, backend='eager', size=4):
+    global _agent, _size
+    torch.set_num_threads(1)
+    _size = size
+    if agent_type == 'expectimax':
+        _agent = ExpectimaxAgent(time_budget=time_budget)
+    else:
+        _agent = DDQNAgent(size*size, 4, memory_capacity=1, encoding=encoding)
+        _agent.load(model_path)
+        _agent.epsilon = 0
+        if backend != 'eager':
+            _agent.predictor = load_model(model_path, encoding, backend)
+
+
+def play_game(seed):
+    np.random.seed(seed)
+    env = Board(_size, seed, engine=default_engine(_size))
+    valid_moves = env.valid_move_mask()
+    latencies = []
+    start = time.perf_counter()
+    with torch.inference_mode():
+        while not env.done:
+            t = time.perf_counter()
+            action = _agent.act(env.state, env.mask_to_invalid_moves(valid_moves))
+            latencies.append(time.perf_counter() - t)
+            _, _, _, valid_moves = env.move_with_mask(env.all_moves[action])
+    return {
+        'seed': seed,
+        'score': env.score_v2,
+        'max_tile': int(1 << int(env.state.max())),
+        'moves': env.turns,
+        'invalid_moves': env.invalid_move,
+        'seconds': time.perf_counter() - start,
+        'latencies': np.array(latencies, dtype=np.float32),
+    }
+
+
+def summarize(games, wall_seconds):
+    scores = np.array([game['score'] for game in games])
+    max_tiles = np.array([game['max_tile'] for game in games])
+    moves = sum(game['moves'] for game in games)
+    latencies = np.concatenate([game['latencies'] for game in games]) * 1e6
+    tiles, counts = np.unique(max_tiles, return_counts=True)
+    return {
+        'games': len(games),
+        'score': {
+            'mean': float(scores.mean()),
+            'std': float(scores.std()),
+            'min': int(scores.min()),
+            'p25': float(np.percentile(scores, 25)),
+            'p50': float(np.percentile(scores, 50)),
+            'p75': float(np.percentile(scores, 75)),
+            'p90': float(np.percentile(scores, 90)),
+            'max': int(scores.max()),
+        },
+        'max_tile_histogram': {str(tile): int(count) for tile, count in zip(tiles, counts)},
+        'reach_rate': {str(tile): float((max_tiles >= tile).mean())
+                       for tile in (512, 1024, 2048, 4096, 8192)},
+        'moves_per_second': moves / wall_seconds,
+        'moves_per_second_per_worker': moves / sum(game['seconds'] for game in games),
+        'latency_us': {
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        'wall_seconds': wall_seconds,
+    }
+
+
+def evaluate(model_name, games=1000, workers=None, first_seed=0, agent_type='dqn',
+             encoding='raw', time_budget=0.01, backend='eager', size=4):
+    if agent_type == 'expectimax' and size != 4:
+        raise ValueError('the expectimax agent plays 4x4 boards only')
+    start = time.perf_counter()
+    with Pool(workers or os.cpu_count(), initializer=init_worker,
+              initargs=(agent_type, f'model/{model_name}', encoding, time_budget,
+                        backend, size)) as pool:
+        results = list(pool.imap_unordered(
+            play_game, range(first_seed, first_seed + games), chunksize=4))
+    results.sort(key=lambda game: game['seed'])
+    return summarize(results, time.perf_counter() - start), results
+
+
+def write_results(summary, games, json_path, csv_path):
+    with open(json_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    fields = ['seed', 'score', 'max_tile', 'moves', 'invalid_moves', 'seconds']
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(games)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Play seeded games headlessly and report how well a model does.')
+    parser.add_argument('model_name', help='file name under model/')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game')
+    parser.add_argument('--agent', choices=['dqn', 'expectimax'], default='dqn')
+    parser.add_argument('--encoding', default='raw')
+    parser.add_argument('--time-budget', type=float, default=0.01,
+                        help='seconds per move for the expectimax agent')
+    parser.add_argument('--backend', choices=BACKENDS, default='eager',
+                        help='inference backend for the dqn agent')
+    parser.add_argument('--size', type=int, default=4,
+                        help='board size the model was trained on, 3 to 8')
+    parser.add_argument('--output', default=None,
+                        help='path prefix for the .json summary and .csv per-game table')
+    args = parser.parse_args()
+
+    summary, games = evaluate(args.model_name, args.games, args.workers, args.seed,
+                              args.agent, args.encoding, args.time_budget, args.backend,
+                              args.size)
+    output = args.output or f'result/{args.model_name}_eval'
+    write_results(summary, games, f'{output}.json', f'{output}.csv')
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,156 @@
+import time
+import numpy as np
+import bitboard
+
+
+# Row features, evaluated on the four log2 exponents of a row. Rows and
+# columns are scored with the same table, so every feature must be
+# symmetric under reading the line in either direction.
+def empty_cells(line):
+    return sum(1 for rank in line if rank == 0)
+
+
+def merges(line):
+    count = 0
+    prev = 0
+    counter = 0
+    for rank in line:
+        if rank == 0:
+            continue
+        if prev == rank:
+            counter += 1
+        elif counter > 0:
+            count += 1 + counter
+            counter = 0
+        prev = rank
+    if counter > 0:
+        count += 1 + counter
+    return count
+
+
+def monotonicity(line, power=4):
+    left = 0
+    right = 0
+    for i in range(1, len(line)):
+        if line[i-1] > line[i]:
+            left += line[i-1]**power - line[i]**power
+        else:
+            right += line[i]**power - line[i-1]**power
+    return -min(left, right)
+
+
+def tile_sum(line, power=3.5):
+    return -sum(rank**power for rank in line)
+
+
+HEURISTICS = {
+    'empty': empty_cells,
+    'merges': merges,
+    'monotonicity': monotonicity,
+    'sum': tile_sum,
+}
+DEFAULT_WEIGHTS = {'empty': 270., 'merges': 700., 'monotonicity': 47., 'sum': 11.}
+# Added per line so any live board scores above a lost one (0).
+LINE_BASELINE = 200000. / 8
+
+_tables = {}
+
+
+def heuristic_table(weights, heuristics=HEURISTICS):
+    key = (tuple(sorted(weights.items())), tuple(sorted(heuristics.items())))
+    if key not in _tables:
+        features = [(heuristics[name], weight) for name, weight in weights.items()]
+        table = []
+        for row in range(65536):
+            line = [(row >> (4*i)) & 0xF for i in range(4)]
+            table.append(LINE_BASELINE +
+                         sum(weight * feature(line) for feature, weight in features))
+        _tables[key] = table
+    return _tables[key]
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class ExpectimaxAgent:
+    def __init__(self, time_budget=0.01, max_depth=8, probability_threshold=1e-4,
+                 weights=None, heuristics=HEURISTICS):
+        self.time_budget = time_budget
+        self.max_depth = max_depth
+        self.probability_threshold = probability_threshold
+        self.table = heuristic_table(weights or DEFAULT_WEIGHTS, heuristics)
+        self.transpositions = {}
+        self.deadline = None
+        self.nodes = 0
+        self.last_depth = 0
+
+    def evaluate(self, board):
+        table = self.table
+        transposed = bitboard.transpose(board)
+        value = 0.
+        for shift in (0, 16, 32, 48):
+            value += table[(board >> shift) & 0xFFFF]
+            value += table[(transposed >> shift) & 0xFFFF]
+        return value
+
+    def act(self, state, invalid_moves):
+        board = bitboard.from_exponents(np.asarray(state))
+        valid_actions = [action for action in range(4) if action not in invalid_moves]
+        best_action = valid_actions[0]
+        self.deadline = time.perf_counter() + self.time_budget
+        self.transpositions = {}
+        self.last_depth = 0
+        # Iterative deepening: keep the answer of the deepest finished search.
+        for depth in range(1, self.max_depth + 1):
+            try:
+                best_action = self.search_root(board, valid_actions, depth)
+            except SearchTimeout:
+                break
+            self.last_depth = depth
+        return best_action
+
+    def search_root(self, board, valid_actions, depth):
+        best_value = -1.
+        best_action = valid_actions[0]
+        for action in valid_actions:
+            new_board = bitboard.move(board, action)[0]
+            if new_board == board:
+                continue
+            value = self.chance_node(new_board, depth - 1, 1.)
+            if value > best_value:
+                best_value, best_action = value, action
+        return best_action
+
+    def max_node(self, board, depth, probability):
+        best_value = 0.
+        for action in range(4):
+            new_board = bitboard.move(board, action)[0]
+            if new_board != board:
+                best_value = max(best_value,
+                                 self.chance_node(new_board, depth - 1, probability))
+        return best_value
+
+    def chance_node(self, board, depth, probability):
+        self.nodes += 1
+        if self.nodes & 0xFF == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        if depth == 0 or probability < self.probability_threshold:
+            return self.evaluate(board)
+
+        # Entries are only reused when they were searched at least as deep.
+        cached = self.transpositions.get(board)
+        if cached is not None and cached[0] >= depth:
+            return cached[1]
+
+        empty = [4*(4*x + y) for x, y in bitboard.empty_positions(board)]
+        value = 0.
+        for shift in empty:
+            value += 0.9 * self.max_node(board | 1 << shift, depth,
+                                         probability * 0.9 / len(empty))
+            value += 0.1 * self.max_node(board | 2 << shift, depth,
+                                         probability * 0.1 / len(empty))
+        value /= len(empty)
+
+        self.transpositions[board] = (depth, value)
+        return value
@@ -1,44 +1,56 @@
 import numpy as np
 import random
 from copy import deepcopy
-import torch
-import os
-import pygame
-import time
-import time
-from RL import DDQNAgent
+import bitboard
+import game_log
+import rowboard
+
+
+def default_engine(size):
+    # The fastest engine that handles the size.
+    return 'bitboard' if size == 4 else 'rows'
 
 
 class Board:
-    def __init__(self, size, random_seed=None):
+    def __new__(cls, size=None, random_seed=None, engine='list', record=False):
+        if cls is Board and engine == 'bitboard':
+            cls = BitBoard
+        elif cls is Board and engine == 'rows':
+            cls = RowBoard
+        return super().__new__(cls)
+
+    def __init__(self, size, random_seed=None, engine='list', record=False):
         self.size = size
         self.grid = [[0]*size for _ in range(size)]
         self.new_tile_position = None
         self.score = 0
         self.score_v2 = 0
         self.random_seed = random_seed
+        # With record=True every move is kept as a game_log move code.
+        self.history = [] if record else None
         if random_seed is not None:
             random.seed(random_seed)
         for _ in range(2):
-            self.score += self.add_random_tile()
+            value = self.add_random_tile()
+            self.score += value
+            if record:
+                self.record_move(0, value)
         self.done = False
         self.merge_this_turn = None
         self.all_moves = ['left', 'down', 'right', 'up']
         self.get_score = 0
         self.turns = 0
         self.invalid_move = 0
-        # self.state = self.one_hot_encode()
-        self.state = np.array(self.grid)
+        # Tiles are stored as log2 exponents (0 for empty), 16 bytes per board.
+        self.state = self.encode()
 
-    def one_hot_encode(self):
-        one_hot = np.zeros((self.size, self.size, 16))
-        for i in range(self.size):
-            for j in range(self.size):
-                if self.grid[i][j] > 0:
-                    index = int(np.log2(self.grid[i][j])) - 1
-                    one_hot[i, j, index] = 1
+    def encode(self):
+        grid = np.array(self.grid)
+        return np.log2(np.maximum(grid, 1)).astype(np.uint8)
 
-        return one_hot
+    def one_hot_encode(self):
+        planes = np.arange(1, rowboard.num_exponents(self.size) + 1)
+        return (self.state[..., None] == planes).astype(np.float64)
 
     def add_random_tile(self):
         self.empty_positions = [(x, y) for x in range(self.size)
@@ -72,6 +84,8 @@ class Board:
             self.done = True
 
         self.score_v2 += self.get_score
+        if self.history is not None:
+            self.record_move(self.all_moves.index(direction), self.score - original_score)
 
         if self.score == original_score:
             reward = -1
@@ -79,9 +93,17 @@ class Board:
         else:
             reward = np.log2(1+self.get_score)/16
 
-        self.state = np.array(self.grid)
+        self.state = self.encode()
         return self.state, reward, self.done
 
+    def record_move(self, action, spawned):
+        # spawned is the value of the tile added after the move, 0 if none.
+        position = None
+        if spawned:
+            x, y = self.new_tile_position
+            position = x*self.size + y
+        self.history.append(game_log.encode_move(action, position, spawned))
+
     def rotate(self):
         for i in range(self.size//2):
             self.grid[i], self.grid[~i] = self.grid[~i], self.grid[i]
@@ -114,177 +136,196 @@ class Board:
                     return False
         return True
 
+    def can_slide(self, line):
+        for i in range(len(line)-1):
+            if line[i] == 0 and line[i+1] != 0:
+                return True
+            if line[i] != 0 and line[i] == line[i+1]:
+                return True
+        return False
+
+    def valid_move_mask(self):
+        rows = self.grid
+        cols = [list(col) for col in zip(*rows)]
+        lines = {
+            'left': rows,
+            'down': [col[::-1] for col in cols],
+            'right': [row[::-1] for row in rows],
+            'up': cols,
+        }
+        mask = 0
+        for i, move in enumerate(self.all_moves):
+            if any(self.can_slide(line) for line in lines[move]):
+                mask |= 1 << i
+        return mask
+
+    @staticmethod
+    def mask_to_invalid_moves(mask):
+        return [i for i in range(4) if not mask >> i & 1]
+
     def get_invalid_moves(self):
-        invalid_moves = []
+        return self.mask_to_invalid_moves(self.valid_move_mask())
 
-        for i, move in enumerate(self.all_moves):
-            original = deepcopy(self)
-            original.move(move)
-            if self.grid == original.grid:
-                invalid_moves.append(i)
-        return invalid_moves
+    def move_with_mask(self, direction):
+        state, reward, done = self.move(direction)
+        return state, reward, done, self.valid_move_mask()
 
 
-class Game:
-    def __init__(self, size, role='human', model_name='AI_model', random_seed=None):
+class BitBoard(Board):
+    def __init__(self, size, random_seed=None, engine='bitboard', record=False):
+        if size != 4:
+            raise ValueError('the bitboard engine only supports 4x4 boards')
+        self.size = size
+        self.board = 0
+        self._state_board = None
+        self.new_tile_position = None
+        self.score = 0
+        self.score_v2 = 0
         self.random_seed = random_seed
-        self.board = Board(size, random_seed)
-        self.role = role
-        self.model_name = model_name
-        self.icon_surface = pygame.image.load("icon.png")
-        pygame.display.set_icon(self.icon_surface)
-        self.screen = pygame.display.set_mode((410, 460))
-        self.font = pygame.font.Font(None, 36)
-        self.color_map = {
-            0: (205, 193, 180),
-            2: (238, 228, 218),
-            4: (237, 224, 200),
-            8: (242, 177, 121),
-            16: (245, 149, 99),
-            32: (246, 124, 95),
-            64: (246, 95, 64),
-            128: (237, 207, 114),
-            256: (237, 204, 97),
-            512: (237, 200, 80),
-            1024: (237, 197, 63),
-            2048: (237, 194, 46),
-        }
-        self.current_dir = os.path.dirname(os.path.abspath(__file__))
-        pygame.mixer.music.load(os.path.join(
-            self.current_dir, 'background.wav'))
-        pygame.mixer.music.play(-1)
-
-        self.sound_effect = pygame.mixer.Sound(
-            os.path.join(self.current_dir, 'merge.wav'))
-        self.sound_effect.set_volume(0.25)
-        self.recommended_move = None
-        self.action_weights = None
-
-    def draw(self):
-        if self.board.merge_this_turn:
-            self.sound_effect.play()
-        self.screen.fill((255, 255, 255))
-        for i in range(self.board.size):
-            for j in range(self.board.size):
-                if i == self.board.new_tile_position[0] and j == self.board.new_tile_position[1]:
-                    color = self.get_tile_color(self.board.grid[i][j])
-                    color = (color[0], color[1], max(0, color[2] - 50))
-                    pygame.draw.rect(self.screen, color,
-                                     (j*100+10, i*100+10, 80, 80))
-                else:
-                    pygame.draw.rect(self.screen, self.get_tile_color(
-                        self.board.grid[i][j]), (j*100+10, i*100+10, 80, 80))
-                if self.board.grid[i][j] != 0:
-                    text = self.font.render(
-                        str(self.board.grid[i][j]), True, (119, 110, 101))
-                    text_rect = text.get_rect(center=(j*100+50, i*100+50))
-                    self.screen.blit(text, text_rect)
-
-        if self.action_weights is not None:
-            max_weight = max(self.action_weights.detach().numpy()[0])
-            min_weight = min(self.action_weights.detach().numpy()[0])
-            for i, action in enumerate(self.board.all_moves):
-                if max_weight == min_weight:
-                    color_intensity = 128
-                else:
-                    weight = self.action_weights.detach().numpy()[0][i]
-                    color_intensity = int(
-                        255 * (weight - min_weight) / (max_weight - min_weight))
-                color = (255 - color_intensity, color_intensity, 0)
-                action_text = self.font.render('O', True, color)
-                if action == 'up':
-                    p = (200, 10)
-                elif action == 'right':
-                    p = (400, 200)
-                elif action == 'down':
-                    p = (200, 400)
-                else:
-                    p = (5, 200)
-                action_rect = action_text.get_rect(center=p)
-                self.screen.blit(action_text, action_rect)
-
-        score_context = "Score: {}".format(self.board.score_v2)
-        if self.board.done:
-            score_context += ", Game over!"
-
-        score_text = self.font.render(score_context, True, (0, 0, 0))
-        score_rect = score_text.get_rect(center=(self.screen.get_width(
-        ) // 2, self.screen.get_height() - 30))
-        self.screen.blit(score_text, score_rect)
-
-        score_box_color = self.get_score_box_color(self.board.score_v2)
-        pygame.draw.rect(self.screen, score_box_color, (0, 410, 410, 50))
-
-        score_context = "Score: {}".format(self.board.score_v2)
-        if self.board.done:
-            score_context += ", Game over!"
-
-        score_text = self.font.render(score_context, True, (0, 0, 0))
-        score_rect = score_text.get_rect(center=(self.screen.get_width(
-        ) // 2, self.screen.get_height() - 25)) 
-        self.screen.blit(score_text, score_rect)
-        if self.recommended_move is not None:
-            recommended_move_text = self.font.render(
-                "AI recommends: " + self.recommended_move, True, (0, 0, 0))
-            recommended_move_rect = recommended_move_text.get_rect(
-                center=(self.screen.get_width() // 2, 400))  
-            self.screen.blit(recommended_move_text, recommended_move_rect)
-        pygame.display.update()
-
-    def get_tile_color(self, value):
-        return self.color_map[value]
-
-    def get_score_box_color(self, score):
-        red = 255
-        green = max(0, 255 - score // 20)
-        blue = 192
-        return (red, green, blue)
-
-    def run(self):
-        if self.role == 'human':
-            while True:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        exit()
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_LEFT:
-                            self.board.move("left")
-                        elif event.key == pygame.K_RIGHT:
-                            self.board.move("right")
-                        elif event.key == pygame.K_UP:
-                            self.board.move("up")
-                        elif event.key == pygame.K_DOWN:
-                            self.board.move("down")
-                        self.draw()
-        elif self.role == 'random':
-            while not self.board.done:
-                self.board.move(random.choices(
-                    self.board.all_moves, (0.9, 0.007, 0.003, 0.1))[0])
-                self.draw()
-                time.sleep(0.1)
-            print('score: ', self.board.score)
-        elif self.role == 'AI':
-            agent = DDQNAgent(16, 4)
-            agent.load(f'model/{self.model_name}')
-            agent.epsilon = 0
-            state = torch.from_numpy(self.board.state).float()
-
-            while not self.board.done:
-                for event in pygame.event.get():
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_DOWN:
-                            while not self.board.done:
-                                time.sleep(0.1)
-                                action = agent.act(
-                                    state, self.board.get_invalid_moves())
-                                self.board.move(self.board.all_moves[action])
-                                state = torch.from_numpy(
-                                    self.board.state).float()
-                                self.action_weights = agent.model(
-                                    torch.from_numpy(self.board.state).float())
-                                # print(self.action_weights)
-                                self.recommended_move = self.board.all_moves[torch.argmax(
-                                    self.action_weights[0]).item()]
-                                self.draw()
-
-            print(self.random_seed, self.board.score_v2, np.max(self.board.grid))
+        self.history = [] if record else None
+        if random_seed is not None:
+            random.seed(random_seed)
+        for _ in range(2):
+            value = self.add_random_tile()
+            self.score += value
+            if record:
+                self.record_move(0, value)
+        self.done = False
+        self.merge_this_turn = None
+        self.all_moves = ['left', 'down', 'right', 'up']
+        self.get_score = 0
+        self.turns = 0
+        self.invalid_move = 0
+        self.valid_moves = bitboard.valid_move_mask(self.board)
+
+    @property
+    def state(self):
+        # Built on first access for each board, so moves whose state is
+        # never read skip the NumPy array.
+        if self._state_board != self.board:
+            self._state = bitboard.to_exponents(self.board)
+            self._state_board = self.board
+        return self._state
+
+    @property
+    def grid(self):
+        return bitboard.to_grid(self.board)
+
+    def add_random_tile(self):
+        self.board, self.new_tile_position, value = bitboard.add_random_tile(
+            self.board)
+        return value
+
+    def move(self, direction):
+        self.turns += 1
+        action = self.all_moves.index(direction)
+        new_board, self.get_score = bitboard.move(self.board, action)
+        self.merge_this_turn = self.get_score > 0
+
+        spawned = 0
+        if new_board != self.board:
+            self.board = new_board
+            spawned = self.add_random_tile()
+            self.score += spawned
+            self.valid_moves = bitboard.valid_move_mask(self.board)
+            self.done = self.valid_moves == 0
+            reward = bitboard.reward(self.get_score)
+        else:
+            reward = -1
+            self.invalid_move += 1
+        if self.history is not None:
+            self.record_move(action, spawned)
+
+        self.score_v2 += self.get_score
+        return self.state, reward, self.done
+
+    def game_over(self):
+        return self.valid_moves == 0
+
+    def valid_move_mask(self):
+        return self.valid_moves
+
+    def move_with_mask(self, direction):
+        state, reward, done = self.move(direction)
+        return state, reward, done, self.valid_moves
+
+
+class RowBoard(Board):
+    # Any size from 3x3 to 8x8 on rowboard's memoized row moves.
+    def __init__(self, size, random_seed=None, engine='rows', record=False):
+        if not rowboard.MIN_SIZE <= size <= rowboard.MAX_SIZE:
+            raise ValueError(f'the rows engine supports {rowboard.MIN_SIZE}x{rowboard.MIN_SIZE} '
+                             f'to {rowboard.MAX_SIZE}x{rowboard.MAX_SIZE} boards')
+        self.size = size
+        self.cells = rowboard.empty(size)
+        self.new_tile_position = None
+        self.score = 0
+        self.score_v2 = 0
+        self.random_seed = random_seed
+        self.history = [] if record else None
+        if random_seed is not None:
+            random.seed(random_seed)
+        for _ in range(2):
+            value = self.add_random_tile()
+            self.score += value
+            if record:
+                self.record_move(0, value)
+        self.done = False
+        self.merge_this_turn = None
+        self.all_moves = ['left', 'down', 'right', 'up']
+        self.get_score = 0
+        self.turns = 0
+        self.invalid_move = 0
+        self.valid_moves = rowboard.valid_move_mask(self.cells)
+        self.state = rowboard.to_exponents(self.cells)
+
+    @property
+    def grid(self):
+        return rowboard.to_grid(self.cells)
+
+    def add_random_tile(self):
+        self.cells, self.new_tile_position, value = rowboard.add_random_tile(self.cells)
+        return value
+
+    def move(self, direction):
+        self.turns += 1
+        action = self.all_moves.index(direction)
+        new_cells, self.get_score = rowboard.move(self.cells, action)
+        self.merge_this_turn = self.get_score > 0
+
+        spawned = 0
+        if new_cells != self.cells:
+            self.cells = new_cells
+            spawned = self.add_random_tile()
+            self.score += spawned
+            self.valid_moves = rowboard.valid_move_mask(self.cells)
+            self.done = self.valid_moves == 0
+            reward = rowboard.reward(self.get_score)
+        else:
+            reward = -1
+            self.invalid_move += 1
+        if self.history is not None:
+            self.record_move(action, spawned)
+
+        self.score_v2 += self.get_score
+        self.state = rowboard.to_exponents(self.cells)
+        return self.state, reward, self.done
+
+    def game_over(self):
+        return self.valid_moves == 0
+
+    def valid_move_mask(self):
+        return self.valid_moves
+
+    def move_with_mask(self, direction):
+        state, reward, done = self.move(direction)
+        return state, reward, done, self.valid_moves
+
+
+def __getattr__(name):
+    # The pygame UI lives in game_ui and is only imported when asked for, so
+    # Board can be used by workers without pygame, torch or a display.
+    if name in ('Game', 'Renderer'):
+        import game_ui
+        return getattr(game_ui, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+import numpy as np
+import bitboard
+import rowboard
+
+# A game log file is MAGIC followed by games, each a fixed-size HEADER and
+# then one move code per move. The first two codes place the starting
+# tiles; every later code is a move:
+#   bits 0-1  action, indexed like Board.all_moves
+#   bit 2     a tile spawned after the move
+#   bit 3     the tile is a 4 (otherwise a 2)
+#   bits 4-   cell index x*size + y of the spawned tile
+# Boards of up to 16 cells use one byte per code, larger boards two.
+
+MAGIC = b'2048LOG\x01'
+HEADER = np.dtype([('seed', '<i8'), ('score', '<u4'), ('turns', '<u4'),
+                   ('max_exponent', 'u1'), ('size', 'u1')])
+INDEX = np.dtype([('file', '<u4'), ('offset', '<u8'), ('seed', '<i8'), ('score', '<u4'),
+                  ('turns', '<u4'), ('max_exponent', 'u1'), ('size', 'u1')])
+EXTENSION = '.glog'
+
+
+def code_dtype(size):
+    return np.dtype(np.uint8) if size*size <= 16 else np.dtype('<u2')
+
+
+def encode_move(action, position=None, value=0):
+    code = action
+    if value:
+        code |= 4 | (value == 4) << 3 | position << 4
+    return code
+
+
+def decode_moves(codes):
+    codes = np.asarray(codes, dtype=np.int64)
+    spawned = (codes & 4) != 0
+    exponents = np.where(spawned, 1 + (codes >> 3 & 1), 0)
+    return codes & 3, spawned, codes >> 4, exponents
+
+
+def pack_game(board):
+    header = np.zeros(1, dtype=HEADER)
+    header['seed'] = -1 if board.random_seed is None else board.random_seed
+    header['score'] = board.score_v2
+    header['turns'] = len(board.history) - 2
+    header['max_exponent'] = board.state.max()
+    header['size'] = board.size
+    return header.tobytes() + np.array(board.history, dtype=code_dtype(board.size)).tobytes()
+
+
+class GameLogWriter:
+    # Appends finished games recorded with Board(..., record=True).
+    def __init__(self, path):
+        self.path = path
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new_file:
+            self.file.write(MAGIC)
+
+    def write(self, board):
+        self.file.write(pack_game(board))
+
+    def state(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def restore(self, offset):
+        # Drop games written after a checkpoint so the log matches it.
+        self.file.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(offset)
+        self.file = open(self.path, 'ab')
+
+    def close(self):
+        self.file.close()
+
+
+def scan(path, offset=None):
+    # Yields (offset, header, codes) for every complete game, reading only the
+    # headers: the codes are views into a read-only memory map.
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f'{path} is not a game log')
+    offset = offset or len(MAGIC)
+    while offset + HEADER.itemsize <= len(data):
+        header = data[offset:offset + HEADER.itemsize].view(HEADER)[0]
+        dtype = code_dtype(int(header['size']))
+        start = offset + HEADER.itemsize
+        end = start + (int(header['turns']) + 2) * dtype.itemsize
+        if end > len(data):
+            # A game cut short by a crash while it was being written.
+            break
+        yield offset, header, data[start:end].view(dtype)
+        offset = end
+
+
+def replay(codes, size=4):
+    # Replays a game, 4x4 at bitboard speed. Yields (board, action,
+    # next_board, gained) per move, as packed bitboards on 4x4 and as
+    # rowboard cells otherwise; next_board includes the tile spawned after
+    # the move.
+    if size != 4:
+        yield from _replay_rows(codes, size)
+        return
+    actions, spawned, positions, exponents = (array.tolist() for array in decode_moves(codes))
+    board = 0
+    for i in range(2):
+        board |= exponents[i] << (4*positions[i])
+    for action, spawn, position, exponent in zip(actions[2:], spawned[2:],
+                                                 positions[2:], exponents[2:]):
+        next_board, gained = bitboard.move(board, action)
+        if spawn:
+            next_board |= exponent << (4*position)
+        yield board, action, next_board, gained
+        board = next_board
+
+
+def _replay_rows(codes, size):
+    actions, spawned, positions, exponents = (array.tolist() for array in decode_moves(codes))
+    cells = [0] * (size*size)
+    for i in range(2):
+        cells[positions[i]] = exponents[i]
+    board = tuple(tuple(cells[i:i+size]) for i in range(0, size*size, size))
+    for action, spawn, position, exponent in zip(actions[2:], spawned[2:],
+                                                 positions[2:], exponents[2:]):
+        next_board, gained = rowboard.move(board, action)
+        if spawn:
+            x, y = divmod(position, size)
+            row = list(next_board[x])
+            row[y] = exponent
+            next_board = next_board[:x] + (tuple(row),) + next_board[x+1:]
+        yield board, action, next_board, gained
+        board = next_board
+
+
+def unpack_boards(boards):
+    boards = np.array(boards, dtype=np.uint64)
+    shifts = np.arange(0, 64, 4, dtype=np.uint64)
+    return ((boards[:, None] >> shifts) & np.uint64(0xF)).astype(np.uint8).reshape(-1, 4, 4)
+
+
+def transitions(codes, size=4):
+    # The (states, actions, rewards, next_states, dones) arrays train_DDQN
+    # would have stored for the game, states as log2 exponents.
+    moves = list(replay(codes, size))
+    boards, actions, next_boards, gained = zip(*moves)
+    engine = bitboard if size == 4 else rowboard
+    unpack = unpack_boards if size == 4 else lambda cells: np.array(cells, dtype=np.uint8)
+    rewards = np.array([engine.reward(score) if next_board != board else -1.
+                        for board, next_board, score in zip(boards, next_boards, gained)],
+                       dtype=np.float32)
+    dones = np.zeros(len(moves), dtype=bool)
+    dones[-1] = engine.valid_move_mask(next_boards[-1]) == 0
+    return (unpack(boards), np.array(actions, dtype=np.uint8), rewards,
+            unpack(next_boards), dones)
+
+
+def game_end(entry):
+    # Offset just past the game of a HEADER or INDEX row.
+    return (int(entry['offset']) + HEADER.itemsize +
+            (int(entry['turns']) + 2) * code_dtype(int(entry['size'])).itemsize)
+
+
+class GameIndex:
+    # One INDEX row per game in a directory of logs, cached in index.npy.
+    # Logs mostly grow, so on reopening only new bytes are scanned. A log
+    # truncated by GameLogWriter.restore and written again is caught by the
+    # header of its last indexed game and scanned from the start.
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = sorted(name for name in os.listdir(directory) if name.endswith(EXTENSION))
+        self.maps = {}
+        self.entries = self.update()
+
+    def fingerprint(self, name, entries):
+        # The header bytes of the last indexed game of a log, as found in
+        # the file now.
+        if not len(entries):
+            return ''
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            f.seek(int(entries[-1]['offset']))
+            return f.read(HEADER.itemsize).hex()
+
+    def update(self):
+        index_path = os.path.join(self.directory, 'index.npy')
+        files_path = os.path.join(self.directory, 'index.json')
+        sizes = {name: os.path.getsize(os.path.join(self.directory, name)) for name in self.files}
+        cached, entries = {}, np.zeros(0, dtype=INDEX)
+        if os.path.exists(index_path) and os.path.exists(files_path):
+            with open(files_path) as f:
+                cached = json.load(f)
+            entries = np.load(index_path)
+
+        # Cached rows of every log whose last indexed game is still in place.
+        kept = {}
+        for name in self.files:
+            if name in cached.get('files', []) and cached['sizes'][name] <= sizes[name]:
+                old = entries[entries['file'] == cached['files'].index(name)].copy()
+                if self.fingerprint(name, old) == cached.get('fingerprints', {}).get(name):
+                    kept[name] = old
+        if cached.get('files') == self.files and cached.get('sizes') == sizes and \
+                len(kept) == len(self.files):
+            return np.load(index_path, mmap_mode='r')
+
+        parts = []
+        fingerprints = {}
+        for i, name in enumerate(self.files):
+            old = kept.get(name, np.zeros(0, dtype=INDEX))
+            old['file'] = i
+            offset = game_end(old[-1]) if len(old) else None
+            rows = [(i, game_offset, header['seed'], header['score'], header['turns'],
+                     header['max_exponent'], header['size'])
+                    for game_offset, header, _ in scan(os.path.join(self.directory, name), offset)]
+            part = np.concatenate([old, np.array(rows, dtype=INDEX)])
+            fingerprints[name] = self.fingerprint(name, part)
+            parts.append(part)
+        entries = np.concatenate(parts) if parts else np.zeros(0, dtype=INDEX)
+
+        np.save(index_path, entries)
+        with open(files_path, 'w') as f:
+            json.dump({'files': self.files, 'sizes': sizes, 'fingerprints': fingerprints}, f)
+        return np.load(index_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def query(self, min_score=0, max_score=None, min_tile=0, max_tile=None):
+        entries = self.entries
+        mask = entries['score'] >= min_score
+        if max_score is not None:
+            mask &= entries['score'] <= max_score
+        if min_tile:
+            mask &= entries['max_exponent'] >= int(min_tile).bit_length() - 1
+        if max_tile is not None:
+            mask &= entries['max_exponent'] <= int(max_tile).bit_length() - 1
+        return entries[mask]
+
+    def codes(self, entry):
+        name = self.files[int(entry['file'])]
+        if name not in self.maps:
+            self.maps[name] = np.memmap(os.path.join(self.directory, name),
+                                        dtype=np.uint8, mode='r')
+        start = int(entry['offset']) + HEADER.itemsize
+        return self.maps[name][start:game_end(entry)].view(code_dtype(int(entry['size'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Index a directory of game logs and list the games that match.')
+    parser.add_argument('directory')
+    parser.add_argument('--min-score', type=int, default=0)
+    parser.add_argument('--max-score', type=int, default=None)
+    parser.add_argument('--min-tile', type=int, default=0)
+    parser.add_argument('--max-tile', type=int, default=None)
+    parser.add_argument('--limit', type=int, default=20, help='games to list')
+    args = parser.parse_args()
+
+    index = GameIndex(args.directory)
+    games = index.query(args.min_score, args.max_score, args.min_tile, args.max_tile)
+    print(f'{len(games)} of {len(index)} games match')
+    if len(games):
+        tiles, counts = np.unique(games['max_exponent'], return_counts=True)
+        print('max tiles:', ', '.join(f'{1 << int(tile)}: {count}'
+                                      for tile, count in zip(tiles, counts)))
+    for entry in games[np.argsort(games['score'])[::-1][:args.limit]]:
+        print(f"{index.files[entry['file']]}@{entry['offset']}: seed {entry['seed']}, "
+              f"score {entry['score']}, max tile {1 << int(entry['max_exponent'])}, "
+              f"{entry['turns']} moves")
@@ -0,0 +1,302 @@
+import numpy as np
+import random
+import os
+import pygame
+import time
+from game_2048 import Board, default_engine
+from game_log import GameLogWriter
+
+
+class Renderer:
+    # Draws Game frames from cached surfaces and only pushes the rects whose
+    # content changed since the previous frame to the display. Tiles are
+    # tile_size - 20 pixels wide on a tile_size pitch.
+    def __init__(self, screen, font, tile_size=100):
+        self.screen = screen
+        self.font = font
+        self.tile_size = tile_size
+        self.surfaces = {}
+        self.last_frame = None
+
+    def text_surface(self, content, color):
+        key = ('text', content, color)
+        if key not in self.surfaces:
+            self.surfaces[key] = self.font.render(content, True, color)
+        return self.surfaces[key]
+
+    def tile_surface(self, value, color):
+        key = ('tile', value, color)
+        if key not in self.surfaces:
+            inner = self.tile_size - 20
+            surface = pygame.Surface((inner, inner))
+            surface.fill(color)
+            if value != 0:
+                # Light text on the dark tiles past 2048.
+                text = self.font.render(str(value), True,
+                                        (119, 110, 101) if value <= 2048 else (249, 246, 242))
+                if text.get_width() > inner - 6:
+                    scale = (inner - 6) / text.get_width()
+                    text = pygame.transform.smoothscale(
+                        text, (inner - 6, max(1, int(text.get_height() * scale))))
+                surface.blit(text, text.get_rect(center=(inner // 2, inner // 2)))
+            self.surfaces[key] = surface
+        return self.surfaces[key]
+
+    def compose(self, game):
+        # Elements in drawing order: name -> (rect, surface or fill color).
+        board = game.board
+        grid = board.grid
+        tile = self.tile_size
+        # Width and height of the board area.
+        side = board.size * tile
+        frame = {}
+        for i in range(board.size):
+            for j in range(board.size):
+                color = game.get_tile_color(grid[i][j])
+                if (i, j) == tuple(board.new_tile_position):
+                    color = (color[0], color[1], max(0, color[2] - 50))
+                frame[('tile', i, j)] = (pygame.Rect(j*tile+10, i*tile+10, tile-20, tile-20),
+                                         self.tile_surface(grid[i][j], color))
+
+        if game.action_weights is not None:
+            max_weight = max(game.action_weights[0])
+            min_weight = min(game.action_weights[0])
+            for i, action in enumerate(board.all_moves):
+                if max_weight == min_weight:
+                    color_intensity = 128
+                else:
+                    weight = game.action_weights[0][i]
+                    color_intensity = int(
+                        255 * (weight - min_weight) / (max_weight - min_weight))
+                color = (255 - color_intensity, color_intensity, 0)
+                action_text = self.text_surface('O', color)
+                if action == 'up':
+                    p = (side // 2, 10)
+                elif action == 'right':
+                    p = (side, side // 2)
+                elif action == 'down':
+                    p = (side // 2, side)
+                else:
+                    p = (5, side // 2)
+                frame[('marker', action)] = (action_text.get_rect(center=p), action_text)
+
+        width, height = self.screen.get_size()
+        frame['score_box'] = (pygame.Rect(0, side + 10, side + 10, 50),
+                              game.get_score_box_color(board.score_v2))
+        score_context = "Score: {}".format(board.score_v2)
+        if board.done:
+            score_context += ", Game over!"
+        # Scores change every move, so they are rendered rather than cached.
+        score_text = self.font.render(score_context, True, (0, 0, 0))
+        frame['score'] = (score_text.get_rect(center=(width // 2, height - 25)), score_text)
+        if game.recommended_move is not None:
+            recommended_move_text = self.text_surface(
+                "AI recommends: " + game.recommended_move, (0, 0, 0))
+            frame['recommended'] = (recommended_move_text.get_rect(
+                center=(width // 2, side)), recommended_move_text)
+        return frame
+
+    def render(self, game):
+        frame = self.compose(game)
+        if self.last_frame is None:
+            dirty = [self.screen.get_rect()]
+        else:
+            dirty = []
+            for name in frame.keys() | self.last_frame.keys():
+                new, old = frame.get(name), self.last_frame.get(name)
+                if new is None or old is None or new[0] != old[0] or new[1] is not old[1] \
+                        and new[1] != old[1]:
+                    dirty.extend(element[0] for element in (new, old) if element is not None)
+
+        for rect in dirty:
+            # Repaint everything overlapping the rect, clipped to it, so
+            # overlapping elements keep their stacking order.
+            self.screen.set_clip(rect)
+            self.screen.fill((255, 255, 255))
+            for element_rect, content in frame.values():
+                if element_rect.colliderect(rect):
+                    if isinstance(content, tuple):
+                        self.screen.fill(content, element_rect)
+                    else:
+                        self.screen.blit(content, element_rect)
+        self.screen.set_clip(None)
+        pygame.display.update(dirty)
+        self.last_frame = frame
+
+
+class Game:
+    def __init__(self, size, role='human', model_name='AI_model', random_seed=None, engine=None,
+                 fps=60, move_delay=0.1, fast_forward=False, game_log=None, backend='eager'):
+        # Sizes 3 to 8; the engine defaults to the fastest one for the size.
+        if role == 'expectimax' and size != 4:
+            raise ValueError('the expectimax role plays 4x4 boards only')
+        self.random_seed = random_seed
+        # Finished games are appended to game_log when it is set.
+        self.game_log = game_log
+        self.game_saved = False
+        self.board = Board(size, random_seed, engine or default_engine(size),
+                           record=game_log is not None)
+        self.role = role
+        self.model_name = model_name
+        self.backend = backend
+        self.current_dir = os.path.dirname(os.path.abspath(__file__))
+        self.icon_surface = pygame.image.load(
+            os.path.join(self.current_dir, "icon.png"))
+        pygame.display.set_icon(self.icon_surface)
+        # 100 pixel tiles up to 7x7, smaller ones on larger boards.
+        self.tile_size = min(100, 720 // size)
+        self.screen = pygame.display.set_mode((size*self.tile_size + 10, size*self.tile_size + 60))
+        self.font = pygame.font.Font(None, 36)
+        self.color_map = {
+            0: (205, 193, 180),
+            2: (238, 228, 218),
+            4: (237, 224, 200),
+            8: (242, 177, 121),
+            16: (245, 149, 99),
+            32: (246, 124, 95),
+            64: (246, 95, 64),
+            128: (237, 207, 114),
+            256: (237, 204, 97),
+            512: (237, 200, 80),
+            1024: (237, 197, 63),
+            2048: (237, 194, 46),
+        }
+        self.audio_loaded = False
+        self.sound_effect = None
+        self.recommended_move = None
+        self.action_weights = None
+        self.renderer = Renderer(self.screen, self.font, self.tile_size)
+        self.fps = fps
+        self.move_delay = move_delay
+        self.fast_forward = fast_forward
+        self.drawn_turn = None
+
+    def load_audio(self):
+        # Audio is loaded on the first frame and skipped when there is no
+        # audio device or the sound files are missing.
+        self.audio_loaded = True
+        if not pygame.mixer.get_init():
+            return
+        music = os.path.join(self.current_dir, 'background.wav')
+        if os.path.exists(music):
+            pygame.mixer.music.load(music)
+            pygame.mixer.music.play(-1)
+        effect = os.path.join(self.current_dir, 'merge.wav')
+        if os.path.exists(effect):
+            self.sound_effect = pygame.mixer.Sound(effect)
+            self.sound_effect.set_volume(0.25)
+
+    def draw(self):
+        if not self.audio_loaded:
+            self.load_audio()
+        if self.board.merge_this_turn and self.sound_effect is not None:
+            self.sound_effect.play()
+        self.renderer.render(self)
+        self.drawn_turn = self.board.turns
+
+    def get_tile_color(self, value):
+        # Tiles past 2048 only show up on larger boards.
+        return self.color_map.get(value, (60, 58, 50))
+
+    def get_score_box_color(self, score):
+        red = 255
+        green = max(0, 255 - score // 20)
+        blue = 192
+        return (red, green, blue)
+
+    def play(self, step):
+        # Moves are made every move_delay seconds (as fast as possible in
+        # fast-forward) while frames are drawn on their own fps clock, so a
+        # fast agent only ever waits for at most one frame per 1/fps.
+        frame_time = 1 / self.fps
+        next_move = next_frame = time.perf_counter()
+        while not self.board.done:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    exit()
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_f:
+                    self.fast_forward = not self.fast_forward
+
+            now = time.perf_counter()
+            if self.fast_forward or now >= next_move:
+                step()
+                next_move = now + self.move_delay
+            if now >= next_frame:
+                if self.drawn_turn != self.board.turns:
+                    self.draw()
+                next_frame = now + frame_time
+            if not self.fast_forward:
+                time.sleep(max(0., min(next_move, next_frame) - time.perf_counter()))
+        self.draw()
+        self.save_game()
+
+    def save_game(self):
+        if self.game_log is None or self.game_saved:
+            return
+        writer = GameLogWriter(self.game_log)
+        writer.write(self.board)
+        writer.close()
+        self.game_saved = True
+
+    def run(self):
+        if self.role == 'human':
+            while True:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        exit()
+                    if event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_LEFT:
+                            self.board.move("left")
+                        elif event.key == pygame.K_RIGHT:
+                            self.board.move("right")
+                        elif event.key == pygame.K_UP:
+                            self.board.move("up")
+                        elif event.key == pygame.K_DOWN:
+                            self.board.move("down")
+                        self.draw()
+                        if self.board.done:
+                            self.save_game()
+        elif self.role == 'random':
+            self.play(lambda: self.board.move(random.choices(
+                self.board.all_moves, (0.9, 0.007, 0.003, 0.1))[0]))
+            print('score: ', self.board.score)
+        elif self.role == 'expectimax':
+            from expectimax import ExpectimaxAgent
+            agent = ExpectimaxAgent()
+
+            def step():
+                action = agent.act(
+                    self.board.state, self.board.get_invalid_moves())
+                self.board.move(self.board.all_moves[action])
+
+            self.play(step)
+            print(self.random_seed, self.board.score_v2, np.max(self.board.grid))
+        elif self.role == 'AI':
+            from RL import DDQNAgent
+            agent = DDQNAgent(self.board.size ** 2, 4)
+            agent.load(f'model/{self.model_name}')
+            agent.epsilon = 0
+            if self.backend != 'eager':
+                from inference import load_model
+                agent.predictor = load_model(f'model/{self.model_name}', backend=self.backend)
+            # One network call per move: the Q-values shown for the current
+            # board are also the ones the next action is chosen from.
+            action_values = agent.q_values(self.board.state)
+
+            def step():
+                nonlocal action_values
+                action = agent.act(
+                    self.board.state, self.board.get_invalid_moves(), action_values)
+                self.board.move(self.board.all_moves[action])
+                action_values = agent.q_values(self.board.state)
+                self.action_weights = action_values
+                self.recommended_move = self.board.all_moves[np.argmax(
+                    self.action_weights[0])]
+
+            while not self.board.done:
+                for event in pygame.event.get():
+                    if event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_DOWN:
+                            self.play(step)
+
+            print(self.random_seed, self.board.score_v2, np.max(self.board.grid))
@@ -0,0 +1,234 @@
+import argparse
+import math
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+from RL import DQN
+
+# Every backend is wrapped as a predictor: a callable from a uint8 array of
+# log2 boards, shape (S, S) or (N, S, S), to float32 Q-values of shape (N, 4).
+# S is the board size the model was trained on, 4 unless stated otherwise.
+BACKENDS = ['eager', 'torchscript', 'onnx', 'numpy']
+
+
+def load_dqn(path, encoding='raw'):
+    # fc1 takes 64 channels per cell, which gives away the board size.
+    state = torch.load(path)
+    model = DQN(encoding, math.isqrt(state['fc1.weight'].shape[1] // 64))
+    model.load_state_dict(state)
+    return model.eval()
+
+
+def quantize_dqn(model):
+    # Only the linear layers hold enough weights for int8 to pay off.
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def to_torchscript(model):
+    example = torch.zeros((1, model.size, model.size), dtype=torch.uint8)
+    with torch.inference_mode():
+        return torch.jit.freeze(torch.jit.trace(model, example).eval())
+
+
+class TorchPredictor:
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, states):
+        with torch.inference_mode():
+            return self.model(torch.as_tensor(states)).numpy()
+
+
+class NumpyPredictor:
+    # The DQN forward pass in plain NumPy. At batch size 1 framework
+    # overhead dominates the tiny network, so a handful of array calls beats
+    # both eager and scripted PyTorch. Activations are kept channels-last as
+    # (N, cells, C); each 3x3 convolution is one gather plus one matmul.
+    def __init__(self, model):
+        self.size = size = model.size
+        params = {name: value.detach().numpy().astype(np.float32)
+                  for name, value in model.state_dict().items()}
+        # The encoder as a table: row e holds the input channels of a cell
+        # with exponent e.
+        boards = torch.arange(model.encoder.num_exponents, dtype=torch.uint8)
+        with torch.inference_mode():
+            encoded = model.encoder(boards[:, None, None].expand(-1, size, size))
+        self.table = encoded[:, :, 0, 0].numpy().astype(np.float32)
+        self.convs = []
+        for name in ('conv1', 'conv2'):
+            weight = params[f'{name}.weight']
+            out_channels, in_channels = weight.shape[:2]
+            self.convs.append((in_channels, self.patch_index(in_channels, size),
+                               weight.transpose(2, 3, 1, 0).reshape(9*in_channels, out_channels),
+                               params[f'{name}.bias']))
+        # fc1 expects the (C, S, S) flattening of PyTorch; reorder its inputs
+        # to the cell-major layout used here.
+        fc1 = params['fc1.weight']
+        channels = self.convs[-1][2].shape[1]
+        fc1 = fc1.reshape(len(fc1), channels, size*size).transpose(0, 2, 1).reshape(len(fc1), -1)
+        self.fcs = [(fc1.T.copy(), params['fc1.bias']),
+                    (params['fc2.weight'].T.copy(), params['fc2.bias']),
+                    (params['fc3.weight'].T.copy(), params['fc3.bias'])]
+
+    @staticmethod
+    def patch_index(channels, size=4):
+        # Flat indices into a zero-padded (S+2, S+2, C) board for every
+        # output cell and every (row offset, column offset, channel) of its
+        # patch.
+        index = np.zeros((size*size, 9*channels), dtype=np.int64)
+        for cell in range(size*size):
+            i, j = divmod(cell, size)
+            offsets = [((i + di)*(size + 2) + (j + dj))*channels + c
+                       for di in range(3) for dj in range(3) for c in range(channels)]
+            index[cell] = offsets
+        return index
+
+    def __call__(self, states):
+        size = self.size
+        x = self.table[np.asarray(states, dtype=np.uint8).reshape(-1, size*size)]
+        n = len(x)
+        for channels, index, weight, bias in self.convs:
+            padded = np.zeros((n, size + 2, size + 2, channels), dtype=np.float32)
+            padded[:, 1:-1, 1:-1] = x.reshape(n, size, size, channels)
+            x = np.maximum(padded.reshape(n, -1).take(index, axis=1) @ weight + bias, 0.)
+        x = x.reshape(n, -1)
+        for weight, bias in self.fcs:
+            x = np.maximum(x @ weight + bias, 0.)
+        return x
+
+
+class OnnxPredictor:
+    def __init__(self, path):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.size = self.session.get_inputs()[0].shape[-1]
+
+    def __call__(self, states):
+        states = np.asarray(states, dtype=np.uint8).reshape(-1, self.size, self.size)
+        return self.session.run(None, {self.input_name: states})[0]
+
+
+def export_onnx(model, path, quantize=False):
+    torch.onnx.export(model, torch.zeros((1, model.size, model.size), dtype=torch.uint8), path,
+                      input_names=['states'], output_names=['q_values'],
+                      dynamic_axes={'states': {0: 'batch'}, 'q_values': {0: 'batch'}},
+                      external_data=False, verbose=False)
+    if quantize:
+        import onnx
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        # The quantizer reruns shape inference and rejects the exporter's own
+        # shape annotations, so they are dropped first.
+        exported = onnx.load(path)
+        del exported.graph.value_info[:]
+        onnx.save(exported, path)
+        quantize_dynamic(path, path, weight_type=QuantType.QInt8)
+    return path
+
+
+def build_predictor(model, backend='eager', quantize=False):
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown inference backend: {backend}')
+    if backend == 'onnx':
+        # Exported to a private file: processes loading the same model at
+        # once never read each other's half-written exports, and files
+        # written with --export are left alone.
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                return OnnxPredictor(export_onnx(model, os.path.join(directory, 'model.onnx'),
+                                                 quantize))
+        except ImportError as e:
+            raise ImportError('the onnx backend needs the onnx and onnxruntime packages') from e
+    if backend == 'numpy':
+        if quantize:
+            raise ValueError('the numpy backend runs in float32 only')
+        return NumpyPredictor(model)
+    if quantize:
+        model = quantize_dqn(model)
+    if backend == 'torchscript':
+        model = to_torchscript(model)
+    return TorchPredictor(model)
+
+
+def check_predictor(predictor, model, samples=4096, tolerance=1e-4, seed=0):
+    # Compares against the eager float model on random boards. Errors are
+    # relative to the largest reference Q-value, so one tolerance fits
+    # every encoding. Raises ValueError past the tolerance.
+    rng = np.random.default_rng(seed)
+    states = rng.integers(0, 14, size=(samples, model.size, model.size), dtype=np.uint8)
+    states[rng.random(states.shape) < 0.4] = 0
+    reference = TorchPredictor(model)(states)
+    error = float(np.abs(predictor(states) - reference).max() / max(np.abs(reference).max(), 1e-12))
+    if error > tolerance:
+        raise ValueError(f'predictor differs from the eager model by {error:.2e} '
+                         f'(relative), tolerance {tolerance:.0e}; pass a larger tolerance '
+                         'to accept it')
+    return error
+
+
+def load_model(path, encoding='raw', backend='eager', quantize=False, check=True,
+               tolerance=None):
+    # Loads a saved state dict from model/ as a predictor. With check=True
+    # the predictor is verified against the eager model before it is used.
+    # The default int8 tolerance rejects raw-encoded models, whose tile
+    # values run into the thousands; an explicit tolerance accepts them.
+    model = load_dqn(path, encoding)
+    predictor = build_predictor(model, backend, quantize)
+    if check:
+        if tolerance is None:
+            tolerance = 5e-2 if quantize else 1e-4
+        check_predictor(predictor, model, tolerance=tolerance)
+    return predictor
+
+
+def latency(predictor, batch_size=1, iterations=2000, size=4):
+    states = np.random.default_rng(0).integers(0, 12, size=(batch_size, size, size),
+                                               dtype=np.uint8)
+    predictor(states)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        predictor(states)
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export a saved model for fast CPU inference and compare the backends.')
+    parser.add_argument('model_name', help='file name under model/')
+    parser.add_argument('--encoding', default='raw')
+    parser.add_argument('--export', choices=['torchscript', 'onnx'], default=None,
+                        help='write model/<model_name>.ts or .onnx')
+    parser.add_argument('--quantize', action='store_true',
+                        help='dynamic int8 quantization of the linear layers')
+    parser.add_argument('--batch-size', type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    path = f'model/{args.model_name}'
+    model = load_dqn(path, args.encoding)
+    if args.export == 'torchscript':
+        scripted = to_torchscript(quantize_dqn(model) if args.quantize else model)
+        torch.jit.save(scripted, f'{path}.ts')
+        print(f'wrote {path}.ts')
+    elif args.export == 'onnx':
+        export_onnx(model, f'{path}.onnx', args.quantize)
+        print(f'wrote {path}.onnx')
+
+    for backend in BACKENDS:
+        for quantize in (False, True):
+            if quantize and backend == 'numpy':
+                continue
+            try:
+                predictor = build_predictor(model, backend, quantize)
+            except ImportError as e:
+                print(f'{backend:12} skipped: {e}')
+                break
+            error = check_predictor(predictor, model, tolerance=float('inf'))
+            print(f"{backend + (' int8' if quantize else ''):17} "
+                  f"{latency(predictor, args.batch_size, size=model.size)*1e6:9.1f} us/call  "
+                  f"max relative error {error:.1e}")
@@ -0,0 +1,215 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+import bitboard
+from inference import BACKENDS, load_model
+
+ALL_MOVES = ['left', 'down', 'right', 'up']
+
+
+class Request:
+    def __init__(self, state):
+        self.state = state
+        self.created = time.perf_counter()
+        self.done = threading.Event()
+        self.q_values = None
+        self.error = None
+
+
+class BatchingPredictor:
+    # Requests arriving within max_delay of the first one in a batch are
+    # evaluated together in a single forward pass.
+    def __init__(self, model, max_batch=256, max_delay=0.002, stats_window=10000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=stats_window)
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.served = 0
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def predict(self, state):
+        request = Request(state)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.q_values
+
+    def run(self):
+        torch.set_num_threads(1)
+        while True:
+            batch = [self.requests.get()]
+            deadline = batch[0].created + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # A failed forward pass fails its batch only; the worker keeps
+            # serving the requests after it.
+            try:
+                q_values = self.model(np.stack([request.state for request in batch]))
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            now = time.perf_counter()
+            with self.lock:
+                self.served += len(batch)
+                self.batch_sizes.append(len(batch))
+                self.latencies.extend(now - request.created for request in batch)
+            for request, values in zip(batch, q_values):
+                request.q_values = values
+                request.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1e3
+            batch_sizes = np.array(self.batch_sizes)
+            served = self.served
+        elapsed = time.perf_counter() - self.started
+        return {
+            'requests': served,
+            'requests_per_second': served / elapsed,
+            'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.,
+            'latency_ms': {
+                'p50': float(np.percentile(latencies, 50)) if len(latencies) else 0.,
+                'p99': float(np.percentile(latencies, 99)) if len(latencies) else 0.,
+            },
+        }
+
+
+def parse_state(body):
+    # Boards come either as log2 exponents ('state') or raw tiles ('grid').
+    # Anything the bitboard and the encoders cannot hold raises ValueError.
+    if 'state' in body:
+        state = np.array(body['state'], dtype=np.int64)
+    else:
+        grid = np.array(body['grid'], dtype=np.int64)
+        if ((grid != 0) & ((grid < 2) | (grid & (grid - 1) != 0))).any():
+            raise ValueError('tiles must be 0 or powers of two')
+        state = np.log2(np.maximum(grid, 1)).astype(np.int64)
+    if state.shape != (4, 4):
+        raise ValueError(f'expected a 4x4 board, got shape {state.shape}')
+    if state.min() < 0 or state.max() > 15:
+        raise ValueError('exponents must be between 0 and 15 (tiles up to 32768)')
+    return state.astype(np.uint8)
+
+
+def recommend(predictor, state):
+    q_values = predictor.predict(state)
+    mask = bitboard.valid_move_mask(bitboard.from_exponents(state))
+    masked = np.where([mask >> i & 1 for i in range(4)], q_values, -np.inf)
+    action = int(np.argmax(masked))
+    return {
+        'q_values': q_values.tolist(),
+        'valid_moves': [move for i, move in enumerate(ALL_MOVES) if mask >> i & 1],
+        'action': action if mask else None,
+        'move': ALL_MOVES[action] if mask else None,
+    }
+
+
+def make_handler(predictor):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, predictor.stats())
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                state = parse_state(body)
+            except (ValueError, KeyError, TypeError, OverflowError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            try:
+                result = recommend(predictor, state)
+            except Exception as e:
+                self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+                return
+            self.send_json(200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(model_name, host='127.0.0.1', port=8048, encoding='raw', backend='eager',
+          quantize=False, max_batch=256, max_delay=0.002, stats_interval=10, tolerance=None,
+          backlog=128):
+    model = load_model(f'model/{model_name}', encoding, backend, quantize, tolerance=tolerance)
+    predictor = BatchingPredictor(model, max_batch, max_delay)
+    # The stdlib listen backlog of 5 resets connections when many clients
+    # connect at once.
+    server = ThreadingHTTPServer((host, port), make_handler(predictor), bind_and_activate=False)
+    server.request_queue_size = backlog
+    try:
+        server.server_bind()
+        server.server_activate()
+    except OSError:
+        server.server_close()
+        raise
+
+    def report():
+        while True:
+            time.sleep(stats_interval)
+            print(json.dumps(predictor.stats()))
+    threading.Thread(target=report, daemon=True).start()
+
+    print(f'serving model/{model_name} on http://{host}:{port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve move recommendations from a saved model over HTTP.')
+    parser.add_argument('model_name', help='file name under model/')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8048)
+    parser.add_argument('--encoding', default='raw')
+    parser.add_argument('--backend', choices=BACKENDS, default='eager')
+    parser.add_argument('--quantize', action='store_true',
+                        help='dynamic int8 quantization of the linear layers')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='largest relative difference from the eager model accepted at load')
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-delay-ms', type=float, default=2.)
+    parser.add_argument('--stats-interval', type=float, default=10.)
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='pending connections the socket queues before refusing more')
+    args = parser.parse_args()
+
+    serve(args.model_name, args.host, args.port, args.encoding, args.backend,
+          args.quantize, args.max_batch, args.max_delay_ms / 1000, args.stats_interval,
+          args.tolerance, args.backlog)
@@ -1,104 +1,132 @@
 import numpy as np
 import torch
-import matplotlib.pyplot as plt
 import os
-import datetime
-import pygame
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
-from game_2048 import Game, Board
+import random
+from game_2048 import Board, default_engine
 from RL import DDQNAgent
-
-sns.set(style='whitegrid')
-
-
-def train_DDQN(episodes, model_name):
-    agent = DDQNAgent(16, 4)
-    record_freq = 50
-    if os.path.exists(f'model/{model_name}'):
+from checkpoint import CheckpointWriter, checkpoint_exists, load_checkpoint
+from metrics import Metrics, PlotProcess, result_plot_path
+from game_log import GameLogWriter
+
+
+def train_DDQN(episodes, model_name, random_seed=0, log_freq=50, profiler=None, game_log=None,
+               batch_size=128, target_update_freq=50, save_freq=250, agent_params=None,
+               stop=None, plot=True, size=4):
+    # agent_params go to DDQNAgent; stop(episode, means) ends training early
+    # when it returns True, after a last checkpoint. A stop with state() and
+    # restore() methods is checkpointed along with the agent. size picks the board,
+    # 3x3 to 8x8.
+    random.seed(random_seed)
+    np.random.seed(random_seed)
+    torch.manual_seed(random_seed)
+    agent = DDQNAgent(size*size, 4, **(agent_params or {}))
+    if profiler is not None:
+        agent.profiler = profiler
+    profiler = agent.profiler
+    checkpoint_path = f'model/{model_name}.ckpt'
+    checkpoints = CheckpointWriter()
+    metrics_path = f'result/{model_name}_metrics.csv'
+    metrics = Metrics(metrics_path, ['score', 'turns', 'invalid_move_ratio', 'loss'])
+    plots = PlotProcess()
+    # Every episode is appended to the game log when a path is given.
+    games = GameLogWriter(game_log) if game_log else None
+    training_state = {'episode': -1}
+    if checkpoint_exists(checkpoint_path):
+        print('resume')
+        training_state = load_checkpoint(agent, checkpoint_path)
+        metrics.restore(training_state['metrics'])
+        if games is not None and 'game_log' in training_state:
+            games.restore(training_state['game_log'])
+        if hasattr(stop, 'restore') and 'stop' in training_state:
+            stop.restore(training_state['stop'])
+    elif os.path.exists(f'model/{model_name}'):
         print('exist')
         agent.load(f'model/{model_name}')
-    scores = []
-    turns = []
-    invalid_move_ratio = []
 
-    env = Board(4, 0)
-    for e in range(episodes):
-        state = torch.from_numpy(env.state).float()
+    # A resumed run continues from the restored RNG state, which already
+    # accounts for the seed.
+    env = Board(size, None, engine=default_engine(size), record=games is not None)
+    e = saved = training_state['episode']
+    for e in range(training_state['episode'] + 1, episodes):
+        state = env.state
+        valid_moves = env.valid_move_mask()
 
         while True:
-            action = agent.act(state, env.get_invalid_moves())
-            next_state, reward, done = env.move(env.all_moves[action])
-            next_state = torch.from_numpy(next_state).float()
-            reward = torch.tensor(reward).float()
-            agent.remember(state, action, reward, next_state, done)
+            with profiler.phase('act'):
+                action = agent.act(state, env.mask_to_invalid_moves(valid_moves))
+            with profiler.phase('env_step'):
+                next_state, reward, done, valid_moves = env.move_with_mask(
+                    env.all_moves[action])
+            with profiler.phase('remember'):
+                agent.remember(state, action, reward, next_state, done)
+            profiler.count('env_steps')
             state = next_state
             if done:
-                print("episode: {:11}/{}, score: {:6}, score(v2): {:7}, turns: {:6}, invalid: {:6}"
-                      .format(e, episodes, env.score, env.score_v2, env.turns - env.invalid_move, env.invalid_move))
-
-                scores.append(env.score_v2)
-                turns.append(env.turns-env.invalid_move)
-                invalid_move_ratio.append(env.invalid_move/env.turns)
                 break
 
-        if e > 128:
-            agent.replay(128)
-
-        if e % record_freq == 0:
-            agent.update_target_model()
-
-        env.__init__(4)
-
-        if e % 250 == 0 and e != 0:
-            agent.save(f'model/{model_name}')
-
-            scores_ma = pd.Series(scores).rolling(window=20).mean()
-            losses_ma = pd.Series(agent.losses).rolling(window=20).mean()
-            turns_ma = pd.Series(turns).rolling(window=20).mean()
-            invalid_move_ma = pd.Series(
-                invalid_move_ratio).rolling(window=20).mean()
-
-            plt.figure(figsize=(12, 20))
-
-            plt.subplot(4, 1, 1)
-            plt.plot(np.arange(len(scores_ma)), scores_ma)
-            plt.ylabel('Score')
-            plt.xlabel('Episode')
-            plt.title('Score over Episodes')
-            plt.grid(True)
-
-            plt.subplot(4, 1, 2)
-            plt.plot(np.arange(len(losses_ma)), losses_ma)
-            plt.yscale('log') 
-            plt.ylabel('Loss (moving average, log scale)')
-            plt.xlabel('Episode')
-            plt.title('Loss over Episodes')
-            plt.grid(True)
-
-            plt.subplot(4, 1, 3)
-            plt.plot(np.arange(len(turns_ma)), turns_ma)
-            plt.ylabel('Turns')
-            plt.xlabel('Episode')
-            plt.title('Turns over Episodes')
-            plt.grid(True)
-
-            plt.subplot(4, 1, 4)
-            plt.plot(np.arange(len(invalid_move_ma)), invalid_move_ma)
-            plt.ylabel('Invalid Moves Ratio')
-            plt.xlabel('Episode')
-            plt.title('Invalid Moves Ratio over Episodes')
-            plt.grid(True)
-
-            plt.tight_layout(pad=3.0) 
-            plt.savefig(
-                f'result/{model_name}_{datetime.datetime.now():%Y%m%d%H%M%S}.png')
+        loss = None
+        if e > batch_size:
+            with profiler.phase('replay'):
+                agent.replay(batch_size)
+            loss = agent.losses[-1]
+
+        with profiler.phase('metrics'):
+            metrics.record(e, score=env.score_v2, turns=env.turns - env.invalid_move,
+                           invalid_move_ratio=env.invalid_move/env.turns, loss=loss)
+            if games is not None:
+                games.write(env)
+        if e % log_freq == 0:
+            means = metrics.means()
+            print("episode: {:11}/{}, score(v2): {:9.1f}, turns: {:7.1f}, invalid: {:.4f}, loss: {:.5f}"
+                  .format(e, episodes, means['score'], means['turns'],
+                          means['invalid_move_ratio'], means['loss']))
+
+        if e % target_update_freq == 0:
+            with profiler.phase('target_sync'):
+                agent.update_target_model()
+
+        stopping = stop is not None and stop(e, metrics.means())
+        if (e % save_freq == 0 and e != 0) or stopping:
+            # Includes any wait for the previous background write.
+            with profiler.phase('checkpoint_io'):
+                agent.save(f'model/{model_name}')
+                training_state = {'episode': e, 'metrics': metrics.state()}
+                if games is not None:
+                    training_state['game_log'] = games.state()
+                if hasattr(stop, 'state'):
+                    training_state['stop'] = stop.state()
+                checkpoints.save(agent, checkpoint_path, training_state)
+                saved = e
+            if plot:
+                with profiler.phase('plot_submit'):
+                    plots.submit(metrics_path, result_plot_path(model_name))
+        profiler.episode(e)
+        if stopping:
+            print(f'stopped early at episode {e}')
+            break
+
+        # Reset after saving: a resumed run redraws this board from the
+        # restored random state.
+        env.__init__(size, record=games is not None)
+
+    if saved != e:
+        agent.save(f'model/{model_name}')
+    checkpoints.wait()
+    metrics.close()
+    if games is not None:
+        games.close()
+    plots.wait()
+    return {'episodes': e + 1, **metrics.means()}
 
 
 if __name__ == '__main__':
+    # The UI is only needed here; trainers that import main stay headless.
+    import pygame
+    from game_ui import Game
+
     model_name = 'fixed_random_seed'
 
+    # Each restart resumes from the last full checkpoint.
     while True:
         train_DDQN(10000000, model_name)
 
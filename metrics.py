@@ -0,0 +1,147 @@
+import argparse
+import csv
+import datetime
+import math
+import multiprocessing
+import os
+from collections import deque
+
+
+class RollingMean:
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.total = 0.
+
+    def update(self, value):
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+
+    def mean(self):
+        return self.total / len(self.values) if self.values else math.nan
+
+
+class Metrics:
+    # Per-episode training metrics: appended to a CSV log on disk and kept in
+    # memory only as fixed-size rolling windows, so recording stays O(1) no
+    # matter how long training runs.
+    def __init__(self, path, fields, window=20, flush_every=50):
+        self.path = path
+        self.fields = fields
+        self.window = window
+        self.flush_every = flush_every
+        self.rolling = {name: RollingMean(window) for name in fields}
+        self.count = 0
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(['episode'] + fields)
+
+    def record(self, episode, **values):
+        self.writer.writerow([episode] + [values[name] for name in self.fields])
+        for name in self.fields:
+            value = values[name]
+            if value is not None and not math.isnan(value):
+                self.rolling[name].update(value)
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()
+
+    def means(self):
+        return {name: rolling.mean() for name, rolling in self.rolling.items()}
+
+    def state(self):
+        self.file.flush()
+        return {
+            'offset': self.file.tell(),
+            'count': self.count,
+            'rolling': {name: list(rolling.values) for name, rolling in self.rolling.items()},
+        }
+
+    def restore(self, state):
+        # Drop rows written after the checkpoint so the log matches it.
+        self.file.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(state['offset'])
+        self.file = open(self.path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        self.count = state['count']
+        for name, values in state['rolling'].items():
+            self.rolling[name] = RollingMean(self.window)
+            for value in values:
+                self.rolling[name].update(value)
+
+    def close(self):
+        self.file.close()
+
+
+def plot_metrics(csv_path, output_path, window=20):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+    sns.set(style='whitegrid')
+
+    data = pd.read_csv(csv_path)
+    panels = [
+        ('score', 'Score', 'Score over Episodes', False),
+        ('loss', 'Loss (moving average, log scale)', 'Loss over Episodes', True),
+        ('turns', 'Turns', 'Turns over Episodes', False),
+        ('invalid_move_ratio', 'Invalid Moves Ratio', 'Invalid Moves Ratio over Episodes', False),
+    ]
+    panels = [panel for panel in panels if panel[0] in data]
+
+    plt.figure(figsize=(12, 5*len(panels)))
+    for i, (column, ylabel, title, log_scale) in enumerate(panels):
+        series = data[['episode', column]].dropna()
+        plt.subplot(len(panels), 1, i+1)
+        plt.plot(series['episode'], series[column].rolling(window=window).mean())
+        if log_scale:
+            plt.yscale('log')
+        plt.ylabel(ylabel)
+        plt.xlabel('Episode')
+        plt.title(title)
+        plt.grid(True)
+
+    plt.tight_layout(pad=3.0)
+    plt.savefig(output_path)
+    plt.close()
+
+
+class PlotProcess:
+    # Renders plots in a separate process; a request is skipped while the
+    # previous plot is still being drawn.
+    def __init__(self):
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+
+    def submit(self, csv_path, output_path, window=20):
+        if self.process is not None and self.process.is_alive():
+            return False
+        self.process = self.context.Process(
+            target=plot_metrics, args=(csv_path, output_path, window), daemon=True)
+        self.process.start()
+        return True
+
+    def wait(self):
+        if self.process is not None:
+            self.process.join()
+
+
+def result_plot_path(model_name):
+    return f'result/{model_name}_{datetime.datetime.now():%Y%m%d%H%M%S}.png'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Plot the metrics log written by train_DDQN.')
+    parser.add_argument('model_name')
+    parser.add_argument('--window', type=int, default=20)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    plot_metrics(f'result/{args.model_name}_metrics.csv',
+                 args.output or result_plot_path(args.model_name), args.window)
@@ -0,0 +1,95 @@
+import cProfile
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+_DISABLED = nullcontext()
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.timers[self.name] += time.perf_counter() - self.start
+        self.profiler.calls[self.name] += 1
+
+
+class Profiler:
+    # Opt-in per-phase timers and event counters. When disabled, phase()
+    # returns a shared no-op context manager and count() returns at once,
+    # so instrumented code pays almost nothing.
+    def __init__(self, enabled=False, summary_interval=60., profile_episodes=None,
+                 profile_path='result/profile.prof', output=print):
+        self.enabled = enabled
+        self.summary_interval = summary_interval
+        self.profile_episodes = profile_episodes
+        self.profile_path = profile_path
+        self.output = output
+        self.profile = None
+        self.reset()
+
+    def reset(self):
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.started = time.perf_counter()
+        self.last_summary = self.started
+
+    def phase(self, name):
+        if not self.enabled:
+            return _DISABLED
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def episode(self, e):
+        # Called once per episode: drives the cProfile window and summaries.
+        if self.profile_episodes is not None:
+            start, stop = self.profile_episodes
+            if e == start and self.profile is None:
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+            elif e == stop and self.profile is not None:
+                self.profile.disable()
+                self.profile.dump_stats(self.profile_path)
+                self.output(f'profile of episodes {start}-{stop} written to {self.profile_path}')
+                self.profile = None
+        if not self.enabled:
+            return
+        self.count('episodes')
+        if time.perf_counter() - self.last_summary >= self.summary_interval:
+            self.output(self.format_summary())
+            self.last_summary = time.perf_counter()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'elapsed': elapsed,
+            'phases': {name: {
+                'seconds': total,
+                'calls': self.calls[name],
+                'mean_us': total / self.calls[name] * 1e6,
+                'share': total / elapsed,
+            } for name, total in self.timers.items()},
+            'rates': {name: count / elapsed for name, count in self.counters.items()},
+        }
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f"profile over {summary['elapsed']:.1f}s:"]
+        for name, phase in sorted(summary['phases'].items(),
+                                  key=lambda item: -item[1]['seconds']):
+            lines.append("  {:<18} {:9.3f}s {:6.1%} {:10} calls {:10.1f} us/call".format(
+                name, phase['seconds'], phase['share'], phase['calls'], phase['mean_us']))
+        for name, rate in sorted(summary['rates'].items()):
+            lines.append(f"  {name + '/s':<18} {rate:12.1f}")
+        return '\n'.join(lines)
@@ -0,0 +1,138 @@
+import math
+import random
+import numpy as np
+
+# An N x N board as a tuple of row tuples of log2 exponents (0 for empty),
+# for sizes the 64-bit bitboard cannot hold. Rows are immutable and recur
+# constantly, so every row move is computed once and then looked up, the
+# way bitboard.py uses its tables. Actions are indexed like
+# Board.all_moves: ['left', 'down', 'right', 'up'].
+
+MIN_SIZE = 3
+MAX_SIZE = 8
+# Bounds the memo tables; they are simply dropped when full.
+MAX_CACHED_ROWS = 1 << 20
+
+_ROW_LEFT = {}
+_ROW_CAN_MOVE = {}
+
+
+def num_exponents(size):
+    # Distinct exponents a board can hold, 0 included: 4x4 boards keep the
+    # 16 of the original encodings, larger boards reach 2**(size*size + 1).
+    return 16 if size <= 4 else size*size + 2
+
+
+def empty(size):
+    return ((0,)*size,)*size
+
+
+def _remember(table, row, result):
+    if len(table) >= MAX_CACHED_ROWS:
+        table.clear()
+    table[row] = result
+    return result
+
+
+def slide_left(row):
+    result = _ROW_LEFT.get(row)
+    if result is None:
+        tiles = [exponent for exponent in row if exponent]
+        merged = []
+        score = 0
+        i = 0
+        while i < len(tiles):
+            if i + 1 < len(tiles) and tiles[i] == tiles[i+1]:
+                merged.append(tiles[i] + 1)
+                score += 1 << (tiles[i] + 1)
+                i += 2
+            else:
+                merged.append(tiles[i])
+                i += 1
+        return _remember(_ROW_LEFT, row, (tuple(merged) + (0,)*(len(row) - len(merged)), score))
+    return result
+
+
+def can_move(row):
+    # Bit 0: the row can slide left, bit 1: it can slide right.
+    result = _ROW_CAN_MOVE.get(row)
+    if result is None:
+        result = 0
+        for a, b in zip(row, row[1:]):
+            if a and a == b:
+                return _remember(_ROW_CAN_MOVE, row, 3)
+            if b and not a:
+                result |= 1
+            elif a and not b:
+                result |= 2
+        return _remember(_ROW_CAN_MOVE, row, result)
+    return result
+
+
+def transpose(cells):
+    return tuple(zip(*cells))
+
+
+def _slide(rows, reverse):
+    moved = []
+    score = 0
+    for row in rows:
+        if reverse:
+            row, gained = slide_left(row[::-1])
+            row = row[::-1]
+        else:
+            row, gained = slide_left(row)
+        moved.append(row)
+        score += gained
+    return tuple(moved), score
+
+
+def move(cells, action):
+    if action == 0:
+        return _slide(cells, False)
+    if action == 2:
+        return _slide(cells, True)
+    moved, score = _slide(transpose(cells), action == 1)
+    return transpose(moved), score
+
+
+def valid_move_mask(cells):
+    # Bit i is set when move(cells, i) changes the board.
+    horizontal = 0
+    vertical = 0
+    for row in cells:
+        horizontal |= can_move(row)
+    for column in transpose(cells):
+        vertical |= can_move(column)
+    return (horizontal & 1) | (vertical >> 1) << 1 | \
+        (horizontal >> 1) << 2 | (vertical & 1) << 3
+
+
+def empty_positions(cells):
+    return [(x, y) for x, row in enumerate(cells) for y, exponent in enumerate(row)
+            if not exponent]
+
+
+def add_random_tile(cells):
+    # The same random draws as the list engine, so seeded games agree.
+    x, y = random.choice(empty_positions(cells))
+    value = 2 if random.random() * 100 < 90 else 4
+    row = list(cells[x])
+    row[y] = value.bit_length() - 1
+    return cells[:x] + (tuple(row),) + cells[x+1:], (x, y), value
+
+
+def reward(score):
+    return math.log2(1+score)/16
+
+
+def to_exponents(cells):
+    return np.array(cells, dtype=np.uint8)
+
+
+def from_exponents(exponents):
+    return tuple(tuple(row) for row in np.asarray(exponents).tolist())
+
+
+def to_grid(cells):
+    return [[1 << exponent if exponent else 0 for exponent in row] for row in cells]
@@ -0,0 +1,239 @@
+import argparse
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# train_DDQN settings; every other parameter of a spec goes to DDQNAgent.
+TRAIN_PARAMS = ['batch_size', 'target_update_freq', 'save_freq', 'size']
+
+# A spec is a JSON object such as
+#   {"name": "lr_gamma", "method": "grid", "episodes": 5000,
+#    "params": {"learning_rate": [1e-4, 3e-4], "gamma": [0.9, 0.99]},
+#    "fixed": {"memory_capacity": 20000}}
+# With "method": "random", "trials" configurations are drawn and each
+# parameter is a list of choices or {"uniform": [low, high]},
+# {"log_uniform": [low, high]} or {"int_uniform": [low, high]}.
+EXAMPLE_SPEC = {
+    'name': 'example',
+    'method': 'random',
+    'trials': 8,
+    'episodes': 3000,
+    'params': {
+        'learning_rate': {'log_uniform': [3e-5, 1e-3]},
+        'gamma': [0.9, 0.95, 0.99],
+        'epsilon_decay': {'uniform': [0.995, 0.9995]},
+        'alpha': {'uniform': [0.4, 0.8]},
+        'batch_size': [64, 128, 256],
+        'target_update_freq': [25, 50, 100],
+    },
+    'fixed': {'memory_capacity': 6000},
+}
+
+
+def sample_value(rng, domain):
+    if isinstance(domain, list):
+        return rng.choice(domain)
+    (kind, (low, high)), = domain.items()
+    if kind == 'uniform':
+        return rng.uniform(low, high)
+    if kind == 'log_uniform':
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    if kind == 'int_uniform':
+        return rng.randint(low, high)
+    raise ValueError(f'unknown search domain: {kind}')
+
+
+def configurations(spec, seed=0):
+    params = spec['params']
+    fixed = spec.get('fixed', {})
+    if spec.get('method', 'grid') == 'grid':
+        names = list(params)
+        for values in itertools.product(*(params[name] for name in names)):
+            yield {**fixed, **dict(zip(names, values))}
+    else:
+        rng = random.Random(seed)
+        for _ in range(spec['trials']):
+            yield {**fixed, **{name: sample_value(rng, domain) for name, domain in params.items()}}
+
+
+class EarlyStopping:
+    # Stops a trial once the rolling score has not improved by min_delta
+    # (relative) for patience episodes, but never before min_episodes.
+    def __init__(self, patience=1000, min_episodes=1000, min_delta=0.01):
+        self.patience = patience
+        self.min_episodes = min_episodes
+        self.min_delta = min_delta
+        self.best = -math.inf
+        self.best_episode = 0
+        self.stopped = False
+
+    def __call__(self, episode, means):
+        score = means['score']
+        if not math.isnan(score) and score > self.best * (1 + self.min_delta):
+            self.best = score
+            self.best_episode = episode
+        self.stopped = (episode >= self.min_episodes and
+                        episode - self.best_episode >= self.patience)
+        return self.stopped
+
+    def state(self):
+        return {'best': self.best, 'best_episode': self.best_episode}
+
+    def restore(self, state):
+        self.best = state['best']
+        self.best_episode = state['best_episode']
+
+
+def trial_outputs(model_name):
+    return [f'model/{model_name}', f'model/{model_name}.ckpt', f'model/{model_name}.ckpt.old',
+            f'result/{model_name}_metrics.csv', f'result/{model_name}.png',
+            f'result/{model_name}_trial.json']
+
+
+def remove_outputs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def run_trial(trial, model_name, params, episodes, threads, random_seed, early_stopping):
+    import torch
+    from main import train_DDQN
+    torch.set_num_threads(threads)
+    stop = EarlyStopping(**early_stopping)
+    agent_params = {name: value for name, value in params.items() if name not in TRAIN_PARAMS}
+    train_params = {name: value for name, value in params.items() if name in TRAIN_PARAMS}
+    start = time.perf_counter()
+    # A resumed trial continues from its last checkpoint, early stopping
+    # included; seconds only count this run.
+    summary = train_DDQN(episodes, model_name, random_seed, log_freq=episodes,
+                         agent_params=agent_params, stop=stop, plot=False, **train_params)
+    result = {
+        'trial': trial,
+        'model_name': model_name,
+        **params,
+        'episodes': summary['episodes'],
+        'stopped_early': stop.stopped,
+        'best_score': stop.best,
+        'final_score': summary['score'],
+        'final_loss': summary['loss'],
+        'seconds': time.perf_counter() - start,
+    }
+    # Marks the trial as finished for a resumed sweep.
+    with open(f'result/{model_name}_trial.json', 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+def write_results(results, path):
+    fields = []
+    for result in results:
+        fields += [name for name in result if name not in fields]
+    with open(f'{path}.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    with open(f'{path}.json', 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def sweep(spec, workers=None, threads=1, random_seed=0, keep=3, early_stopping=None,
+          resume=False):
+    # Trial names are derived from the spec name, so a sweep that already
+    # has outputs is only continued with resume=True: finished trials are
+    # skipped and interrupted ones go on from their last checkpoint.
+    name = spec['name']
+    trials = list(configurations(spec, random_seed))
+    model_names = [f'{name}_{i:03d}' for i in range(len(trials))]
+    existing = [path for model_name in model_names for path in trial_outputs(model_name)
+                if os.path.exists(path)]
+    if existing and not resume:
+        raise FileExistsError(f'sweep {name} already has outputs such as {existing[0]}; '
+                              'resume it or give the spec another name')
+
+    results = []
+    pending = []
+    for i, (model_name, params) in enumerate(zip(model_names, trials)):
+        if os.path.exists(f'result/{model_name}_trial.json'):
+            with open(f'result/{model_name}_trial.json') as f:
+                results.append(json.load(f))
+        else:
+            if not os.path.exists(f'model/{model_name}.ckpt') and \
+                    not os.path.exists(f'model/{model_name}.ckpt.old'):
+                # Interrupted before its first checkpoint: start over.
+                remove_outputs(trial_outputs(model_name))
+            pending.append((i, model_name, params))
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    print(f'{len(pending)} of {len(trials)} trials of {name} to run '
+          f'on {workers} workers x {threads} threads')
+
+    # A fresh spawned process per trial: nothing leaks between trials and
+    # each one sets its own thread count.
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             max_tasks_per_child=1) as pool:
+        futures = [pool.submit(run_trial, i, model_name, params, spec['episodes'],
+                               threads, random_seed, early_stopping or {})
+                   for i, model_name, params in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"trial {result['trial']:3}: best score {result['best_score']:9.1f} after "
+                  f"{result['episodes']} episodes ({result['seconds']:.0f}s)")
+
+    results.sort(key=lambda result: -result['best_score'])
+    write_results(results, f'result/{name}_sweep')
+
+    # Full checkpoints are large; only the best trials keep theirs. Every
+    # trial keeps its weights in model/ and its metrics in result/.
+    for result in results[keep:]:
+        remove_outputs([f"model/{result['model_name']}.ckpt",
+                        f"model/{result['model_name']}.ckpt.old"])
+    from metrics import plot_metrics
+    for result in results[:keep]:
+        plot_metrics(f"result/{result['model_name']}_metrics.csv",
+                     f"result/{result['model_name']}.png")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Train DDQN configurations from a grid or random search spec in parallel.')
+    parser.add_argument('spec', nargs='?', default=None,
+                        help='JSON spec file; prints an example spec when omitted')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='trials run at once (default: CPU count / threads)')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per trial')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='training seed of every trial and seed of the random search')
+    parser.add_argument('--keep', type=int, default=3,
+                        help='number of best trials whose full checkpoints are kept')
+    parser.add_argument('--patience', type=int, default=1000,
+                        help='episodes without a better rolling score before a trial stops')
+    parser.add_argument('--min-episodes', type=int, default=1000)
+    parser.add_argument('--min-delta', type=float, default=0.01,
+                        help='relative gain in rolling score that counts as better')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue a sweep that already has outputs')
+    args = parser.parse_args()
+
+    if args.spec is None:
+        print(json.dumps(EXAMPLE_SPEC, indent=2))
+    else:
+        with open(args.spec) as f:
+            spec = json.load(f)
+        try:
+            results = sweep(spec, args.workers, args.threads, args.seed, args.keep,
+                            {'patience': args.patience, 'min_episodes': args.min_episodes,
+                             'min_delta': args.min_delta}, args.resume)
+        except FileExistsError as e:
+            parser.error(f'{e} (--resume)')
+        print(f"best: {results[0]['model_name']} with rolling score {results[0]['best_score']:.1f}")
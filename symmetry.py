@@ -0,0 +1,71 @@
+from functools import lru_cache
+import numpy as np
+import bitboard
+
+# The 8 dihedral symmetries of a square board. Transform k transposes the
+# board if k & 4, then mirrors it left-right if k & 1, then flips it
+# upside down if k & 2 (the order of bitboard.symmetries). Actions are
+# indexed like Board.all_moves: ['left', 'down', 'right', 'up'].
+
+NUM_SYMMETRIES = 8
+DIRECTIONS = [(0, -1), (1, 0), (0, 1), (-1, 0)]
+
+
+def transform(states, k):
+    if k & 4:
+        states = np.swapaxes(states, -1, -2)
+    if k & 1:
+        states = states[..., ::-1]
+    if k & 2:
+        states = states[..., ::-1, :]
+    return states
+
+
+@lru_cache(maxsize=None)
+def cell_table(size):
+    # cell_table(size)[k][i] is the cell of the original board that lands on
+    # cell i of image k.
+    return np.array([transform(np.arange(size*size).reshape(size, size), k).ravel()
+                     for k in range(NUM_SYMMETRIES)])
+
+
+def _build_tables():
+    # ACTIONS[k][a] is the action on image k that does what action a does on
+    # the original board, on boards of every size.
+    cells = cell_table(4)
+    actions = np.zeros((NUM_SYMMETRIES, 4), dtype=np.int64)
+    for k in range(NUM_SYMMETRIES):
+        target = np.argsort(cells[k])
+        for a, (dr, dc) in enumerate(DIRECTIONS):
+            start = divmod(target[5], 4)
+            end = divmod(target[5 + 4*dr + dc], 4)
+            actions[k, a] = DIRECTIONS.index((end[0] - start[0], end[1] - start[1]))
+    return cells, actions
+
+
+CELLS, ACTIONS = _build_tables()
+
+
+def canonical(state):
+    # The image with the smallest key stands for all eight: the packed
+    # bitboard on 4x4 boards, the cell bytes on other sizes. Returns that
+    # key and the transform that produces it.
+    if state.shape == (4, 4):
+        images = bitboard.symmetries(bitboard.from_exponents(state))
+    else:
+        images = [np.ascontiguousarray(transform(state, k)).tobytes()
+                  for k in range(NUM_SYMMETRIES)]
+    key = min(images)
+    return key, images.index(key)
+
+
+def augment(states, actions, rewards, next_states, dones):
+    # Expands a batch of transitions into all 8 images, transform-major:
+    # row k*B + i is transition i under transform k.
+    batch, size = len(actions), states.shape[-1]
+    cells = cell_table(size)
+    states = states.reshape(batch, -1)[:, cells].transpose(1, 0, 2).reshape(-1, size, size)
+    next_states = next_states.reshape(batch, -1)[:, cells].transpose(1, 0, 2).reshape(
+        -1, size, size)
+    return (states, ACTIONS[:, actions].ravel(), np.tile(rewards, NUM_SYMMETRIES),
+            next_states, np.tile(dones, NUM_SYMMETRIES))
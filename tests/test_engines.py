@@ -0,0 +1,29 @@
+import random
+import numpy as np
+import pytest
+from game_2048 import Board
+
+
+def play(engine, seed, size=4):
+    # Moves are drawn from their own seeded stream, so every engine sees the
+    # same sequence of actions for a seed.
+    rng = random.Random(seed)
+    board = Board(size, seed, engine=engine)
+    trace = []
+    while not board.done:
+        action = rng.randrange(4)
+        state, reward, done = board.move(board.all_moves[action])
+        trace.append((np.array(state), reward, done, board.score,
+                      tuple(board.new_tile_position), board.valid_move_mask()))
+    return trace
+
+
+@pytest.mark.parametrize('engine, size', [('bitboard', 4), ('rows', 4), ('rows', 3), ('rows', 5)])
+@pytest.mark.parametrize('seed', range(20))
+def test_engine_matches_list(engine, size, seed):
+    expected = play('list', seed, size)
+    actual = play(engine, seed, size)
+    assert len(actual) == len(expected)
+    for (state, reward, done, score, position, mask), step in zip(expected, actual):
+        assert np.array_equal(state, step[0])
+        assert (reward, done, score, position, mask) == step[1:]
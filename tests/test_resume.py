@@ -0,0 +1,31 @@
+import os
+import torch
+from main import train_DDQN
+
+
+def train(directory, monkeypatch, stops):
+    # Each entry of stops is one run, resumed from the checkpoint of the
+    # run before it.
+    os.makedirs(directory / 'model')
+    os.makedirs(directory / 'result')
+    monkeypatch.chdir(directory)
+    for episodes in stops:
+        train_DDQN(episodes, 'm', log_freq=1000, game_log='result/m.glog', batch_size=16,
+                   save_freq=10, agent_params={'memory_capacity': 300}, plot=False)
+    with open('result/m_metrics.csv') as f:
+        metrics = f.read()
+    with open('result/m.glog', 'rb') as f:
+        games = f.read()
+    return torch.load('model/m'), metrics, games
+
+
+def test_resumed_training_matches_uninterrupted(tmp_path, monkeypatch):
+    # Runs stop between checkpoints as well as right after one, and the
+    # replay memory wraps around between saves.
+    weights, metrics, games = train(tmp_path / 'whole', monkeypatch, [60])
+    split_weights, split_metrics, split_games = train(tmp_path / 'split', monkeypatch,
+                                                      [25, 41, 60])
+    assert weights.keys() == split_weights.keys()
+    assert all(torch.equal(weights[name], split_weights[name]) for name in weights)
+    assert metrics == split_metrics
+    assert games == split_games